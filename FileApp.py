@@ -3,9 +3,26 @@ import os
 import re
 import json
 import time
-import copy
-from threading import Thread
+from threading import Thread, BoundedSemaphore, Condition, Lock, RLock, local
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 import traceback
+import zlib
+import heapq
+import itertools
+import selectors
+import select
+import random
+import multiprocessing
+import signal
+import bisect
+import fnmatch
+import hashlib
+import lzma
+import bz2
+import struct
+import cProfile
+import pstats
 from socket import *
 from past.builtins import raw_input
 
@@ -18,10 +35,1051 @@ FILENAME_STRING = "FILENAME"
 OWNER_STRING = "OWNER"
 IP_ADDRESS_STRING = "IP ADDRESS"
 TCP_PORT_STRING = "TCP PORT"
+MAX_DATAGRAM_SIZE = 65507  # receive buffer for control messages, the largest UDP payload
+UDP_PAYLOAD_LIMIT = 1400  # larger tables and requests go over TCP to the server instead, avoiding IP fragmentation
+RETRY_INTERVAL = 0.5  # seconds before an unacknowledged control message is first sent again
+RETRY_BACKOFF = 2  # each further retry waits this many times longer than the previous one
+MAX_RETRIES = 3
+PAGE_SIZE = 50  # rows printed per page by list and search
+REPLY_CACHE_SIZE = 10000  # replies the server keeps to answer retransmitted requests without applying them twice
+RESYNC_TIMEOUT = 1.0  # seconds before an unanswered full table request is sent again
+DEFAULT_DATA_DIR = "server_data"  # where the server keeps its registry log and snapshots
+COMPACT_INTERVAL = 10000  # registry log records written before the table is compacted into a new snapshot
+REPLICATION_POLL = 0.01  # seconds a server worker waits for other workers' changes before checking again
+SNAPSHOT_WAIT = 1.0  # seconds a snapshot request waits for a worker to catch up with the version it asks for
+SNAPSHOT_THREADS = 16  # TCP connections to the server served at once, the others wait for a thread
+REORDER_KEY = "REORDER"  # retransmit key of the resync requested when a broadcast arrives ahead of the one before it
+CHUNK_SIZE = 64 * 1024  # bytes read/written per iteration of a peer file transfer
+PARTIAL_SUFFIX = ".part"
+CHECKPOINT_SUFFIX = ".ckpt"  # stored next to the partial file, records which of its bytes are safely on disk
+CHECKPOINT_INTERVAL = 8 * 1024 * 1024  # bytes written to a partial file between checkpoint updates
+MANIFEST_CHUNK_SIZE = 1024 * 1024  # bytes covered by each hash in a file's manifest, SEGMENT_SIZE is a multiple of it
+HASH_CACHE_NAME = ".fileapp_hashes.json"  # manifests of the files in a directory, reused while size and mtime match
+# codec name -> (compressor factory, decompressor factory), listed fastest first. A requester sends the names it accepts
+CODECS = OrderedDict([("zlib", (lambda: zlib.compressobj(6), zlib.decompressobj)),
+                      ("bz2", (lambda: bz2.BZ2Compressor(1), bz2.BZ2Decompressor)),
+                      ("lzma", (lambda: lzma.LZMACompressor(preset=1), lzma.LZMADecompressor))])
+MIN_COMPRESS_SIZE = 64 * 1024  # ranges shorter than this are always sent raw
+COMPRESSION_SAMPLES = 4  # CHUNK_SIZE samples spread over a file used to pick its codec
+MIN_COMPRESSION_SAVING = 0.1  # a codec is only used if it is estimated to make the transfer this much faster
+COMPRESSION_LINK_RATE = 12.5 * 1024 * 1024  # bytes/s assumed for an upload without a limit, a 100 Mbit/s link
+COMPRESSED_CACHE_CANDIDATES = 4096  # ranges sent compressed once that are remembered, a second request caches the body
+FRAME_HEADER = struct.Struct("!I")  # length of each frame of a compressed body, a zero length frame ends the body
+COMPRESSED_CACHE_NAME = ".fileapp_cache"  # compressed bodies kept in the offered directory for repeat downloads
+DEFAULT_COMPRESSED_CACHE_SIZE = 256  # MB
+DEFAULT_TCP_BACKLOG = 64  # pending peer connections queued by the kernel
+DEFAULT_MAX_TRANSFERS = 16  # peer requests served in parallel
+PEER_CONNECTIONS_PER_TRANSFER = 4  # open peer connections per transfer slot, idle ones make room for new peers beyond that
+DEFAULT_CONNECTION_TIMEOUT = 30  # seconds a peer connection may stall before it is dropped
+ACCEPT_POLL_INTERVAL = 1.0  # seconds between checks of stop_tcp_listening while idle
+PEER_IDLE_TIMEOUT = 10  # seconds a peer connection is kept open waiting for the requester's next request
+POOL_IDLE_TIMEOUT = 5  # seconds a requester reuses an idle peer connection, shorter than PEER_IDLE_TIMEOUT
+POOL_MAX_IDLE = 4  # idle connections kept per peer
+PIPELINE_DEPTH = 16  # requests a batch request sends ahead of the reply it is reading
+UPLOAD_BURST = 0.1  # seconds of an upload limit that can be sent at once after an idle period
+SMALL_UPLOAD_SIZE = 1024 * 1024  # uploads up to this size are scheduled ahead of larger ones
+SMALL_UPLOAD_WEIGHT = 8  # share of a small upload relative to a large one waiting for the same limit
+UNLIMITED_SLICE = 4 * 1024 * 1024  # bytes per sendfile() call while no limit applies, limits set meanwhile apply from the next slice
+RATE_WINDOW = 5.0  # seconds over which achieved upload rates are measured
+RATE_UNITS = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+SEGMENT_SIZE = 4 * 1024 * 1024  # byte range fetched per request when a file is downloaded from several owners
+MIN_SPLIT_SIZE = 1024 * 1024  # an in-flight range is only split with an idle owner if this much of it is left
+STATS_INTERVAL = 10  # seconds between writes of the stats file and the profile
+HISTOGRAM_SAMPLES = 1024  # most recent observations a histogram keeps for its percentiles
+
+
+def send_message(sock, message):
+    # peer messages are newline terminated JSON headers, any file data follows the header as raw bytes
+    sock.sendall((json.dumps(message) + "\n").encode())
+
+
+def read_message(reader):
+    line = reader.readline()
+    if not line:
+        return None
+    return json.loads(line.decode())
+
+
+def encode_snapshot(snapshot):
+    return zlib.compress(json.dumps(snapshot).encode())
+
+
+def decode_snapshot(data):
+    return json.loads(zlib.decompress(data).decode())
+
+
+def manifest_digest(hashes):
+    return hashlib.sha256("".join(hashes).encode()).hexdigest()
+
+
+def send_frame(sock, cache_file, data):
+    frame = FRAME_HEADER.pack(len(data)) + data
+    sock.sendall(frame)
+    if cache_file is not None:
+        cache_file.write(frame)
+
+
+def read_frame(reader, decompressor):
+    # returns the next decompressed bytes of a compressed body, b'' once its last frame has been read
+    while True:
+        header = reader.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            raise ConnectionError("connection closed inside a compressed body")
+        frame_length, = FRAME_HEADER.unpack(header)
+        if frame_length == 0:
+            return b''
+        frame = reader.read(frame_length)
+        if len(frame) < frame_length:
+            raise ConnectionError("connection closed inside a compressed body")
+        data = decompressor.decompress(frame)
+        if data:
+            return data
+
+
+def parse_rate(value):
+    # bytes per second, optionally with a K, M or G suffix
+    multiplier = RATE_UNITS.get(value[-1:].upper(), 1)
+    rate = float(value[:-1] if multiplier > 1 else value) * multiplier
+    if rate <= 0:
+        raise ValueError(f"invalid rate {value}")
+    return rate
+
+
+def parse_codecs(value):
+    # comma separated codec names
+    codecs = [name for name in value.split(",") if name]
+    if not codecs or any(name not in CODECS for name in codecs):
+        raise ValueError(f"invalid codecs {value}")
+    return codecs
+
+
+def format_rate(rate):
+    for unit in ("G", "M", "K"):
+        if rate >= RATE_UNITS[unit]:
+            return f"{rate / RATE_UNITS[unit]:.1f} {unit}B/s"
+    return f"{rate:.0f} B/s"
+
+
+def parse_options(args, allowed_options):
+    # optional "--name value" pairs that follow the positional command line arguments
+    options = {}
+    if len(args) % 2 != 0:
+        sys.exit(f"[Invalid options: {' '.join(args)}]")
+    for i in range(0, len(args), 2):
+        name = args[i][2:].replace('-', '_')
+        if not args[i].startswith("--") or name not in allowed_options:
+            sys.exit(f"[Invalid option {args[i]}]")
+        try:
+            options[name] = allowed_options[name](args[i + 1])
+        except ValueError:
+            sys.exit(f"[Invalid value for option {args[i]}]")
+        if isinstance(options[name], (int, float)) and options[name] <= 0:
+            sys.exit(f"[Invalid value for option {args[i]}]")
+    return options
+
+
+class Histogram(object):
+    # count, sum, min and max of every observation, percentiles of the most recent HISTOGRAM_SAMPLES
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.samples = deque(maxlen=HISTOGRAM_SAMPLES)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.samples.append(value)
+
+    def summary(self):
+        samples = sorted(self.samples)
+        summary = {"count": self.count, "mean": round(self.total / self.count, 3), "min": round(self.min, 3),
+                   "max": round(self.max, 3)}
+        for percentile in (50, 95, 99):
+            summary[f"p{percentile}"] = round(samples[min(len(samples) * percentile // 100, len(samples) - 1)], 3)
+        return summary
+
+
+class Metrics(object):
+    # counters, gauges and histograms updated from every thread of a client or server process
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def adjust(self, name, amount):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {"uptime": round(time.time() - self.started, 3), "counters": dict(sorted(self.counters.items())),
+                    "gauges": dict(sorted(self.gauges.items())),
+                    "histograms": {name: self.histograms[name].summary() for name in sorted(self.histograms)}}
+
+    def dump(self, path):
+        with open(path + ".tmp", 'w') as stats_file:
+            json.dump(self.snapshot(), stats_file, indent=2)
+        os.replace(path + ".tmp", path)
+
+
+class Profiler(object):
+    # opt-in cProfile of the event loop and the transfer loops, used as "with profiler:" around them. Before Python
+    # 3.12 cProfile only sees the thread that enabled it, so every thread has its own profile and they are merged when
+    # written. From 3.12 only one profile can be enabled in the process and it sees every thread, so a single profile
+    # is enabled at the first section and left on
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = Lock()
+        self.local = local()
+        self.profiles = []  # [profile, depth of profiled sections the thread is in] of every thread
+        self.process_profile = None  # the single profile from Python 3.12
+
+    def __enter__(self):
+        if self.path is None:
+            return
+        if sys.version_info >= (3, 12):
+            with self.lock:
+                if self.process_profile is None:
+                    profile = cProfile.Profile()
+                    try:
+                        profile.enable()
+                    except ValueError:
+                        # another profiling tool such as a debugger is active, the section runs unprofiled
+                        return
+                    self.process_profile = profile
+            return
+        state = getattr(self.local, "state", None)
+        with self.lock:
+            if state is None:
+                state = self.local.state = [cProfile.Profile(), 0]
+                self.profiles.append(state)
+            if state[1] == 0:
+                state[0].enable()
+            state[1] += 1
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.path is None or sys.version_info >= (3, 12):
+            return
+        state = self.local.state
+        with self.lock:
+            state[1] -= 1
+            if state[1] == 0:
+                state[0].disable()
+
+    def dump(self):
+        # sections still running are added once they end, by a later dump
+        if self.path is None:
+            return
+        with self.lock:
+            stats = None
+            profiles = [profile for profile, depth in self.profiles if depth == 0]
+            if self.process_profile is not None:
+                profiles.append(self.process_profile)
+            for profile in profiles:
+                try:
+                    if stats is None:
+                        stats = pstats.Stats(profile)
+                    else:
+                        stats.add(profile)
+                except TypeError:
+                    # nothing recorded yet
+                    pass
+            if self.process_profile is not None:
+                # reading the stats disabled it
+                try:
+                    self.process_profile.enable()
+                except ValueError:
+                    self.process_profile = None
+            if stats is not None:
+                stats.dump_stats(self.path)
+
+
+class HashCache(object):
+    # per-chunk sha256 manifests of the files in one directory, persisted in the directory so files are only
+    # rehashed when their size or modification time changes. New manifests are only kept in memory until save()
+
+    def __init__(self, directory):
+        self.lock = Lock()
+        self.directory = directory
+        self.cache_path = os.path.join(directory, HASH_CACHE_NAME)
+        self.changed = False
+        try:
+            with open(self.cache_path) as cache_file:
+                self.manifests = json.load(cache_file)
+        except (OSError, ValueError):
+            self.manifests = {}
+        self.chunk_owners = {}  # chunk hash -> names of the files with a cached manifest that contain it
+        for name, manifest in self.manifests.items():
+            self.index_chunks(name, manifest)
+
+    def index_chunks(self, name, manifest):
+        for chunk_hash in manifest["hashes"]:
+            self.chunk_owners.setdefault(chunk_hash, set()).add(name)
+
+    def cached(self, file_path, stat=None):
+        # the manifest of the file if it has not changed since it was hashed, otherwise None
+        if stat is None:
+            stat = os.stat(file_path)
+        with self.lock:
+            cached = self.manifests.get(os.path.basename(file_path))
+        if cached is not None and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns \
+                and cached["chunk_size"] == MANIFEST_CHUNK_SIZE:
+            return cached
+        return None
+
+    def containing(self, chunk_hashes):
+        # (file name, manifest) of the files with any of the chunks whose manifest is cached and up to date, a file's
+        # actual chunks are checked against the manifest when they are read
+        with self.lock:
+            names = set()
+            for chunk_hash in chunk_hashes:
+                names.update(self.chunk_owners.get(chunk_hash, ()))
+        manifests = []
+        for name in sorted(names):
+            try:
+                manifest = self.cached(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            if manifest is not None:
+                manifests.append((name, manifest))
+        return manifests
+
+    def manifest(self, file_path):
+        # {"size", "chunk_size", "hashes", "digest"}, the digest is the hash of the concatenated chunk hashes
+        stat = os.stat(file_path)
+        cached = self.cached(file_path, stat)
+        if cached is not None:
+            return cached
+        hashes = []
+        with open(file_path, 'rb') as file:
+            while True:
+                chunk = file.read(MANIFEST_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hashes.append(hashlib.sha256(chunk).hexdigest())
+        manifest = {"size": stat.st_size, "chunk_size": MANIFEST_CHUNK_SIZE, "hashes": hashes,
+                    "digest": manifest_digest(hashes)}
+        self.store(file_path, manifest, stat.st_mtime_ns)
+        return manifest
+
+    def store(self, file_path, manifest, mtime_ns=None):
+        if mtime_ns is None:
+            mtime_ns = os.stat(file_path).st_mtime_ns
+        with self.lock:
+            self.manifests[os.path.basename(file_path)] = dict(manifest, mtime_ns=mtime_ns)
+            # names stay indexed under the chunks of older versions, containing() skips them
+            self.index_chunks(os.path.basename(file_path), manifest)
+            self.changed = True
+
+    def save(self):
+        # written once per batch of files rather than for every file hashed
+        with self.lock:
+            if not self.changed:
+                return
+            with open(self.cache_path + ".tmp", 'w') as cache_file:
+                json.dump(self.manifests, cache_file)
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+            self.changed = False
+
+
+class CompressedCache(object):
+    # compressed bodies of the ranges sent to other clients, stored framed as they were sent so a repeat download is
+    # served with sendfile. A body is only stored the second time its range is requested, and least recently used
+    # bodies are removed once the cache grows past max_bytes
+
+    def __init__(self, directory, max_bytes):
+        self.lock = Lock()
+        self.cache_dir = os.path.join(directory, COMPRESSED_CACHE_NAME)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # cache file name -> size, least recently used first
+        self.total_bytes = 0
+        self.candidates = OrderedDict()  # names of the bodies sent once but not stored, least recently sent first
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cached_files = []
+        for cached_name in os.listdir(self.cache_dir):
+            cached_path = os.path.join(self.cache_dir, cached_name)
+            if cached_name.endswith(".tmp"):
+                # left behind by a transfer that was interrupted
+                os.remove(cached_path)
+            else:
+                stat = os.stat(cached_path)
+                cached_files.append((stat.st_mtime, cached_name, stat.st_size))
+        for _, cached_name, size in sorted(cached_files):
+            self.entries[cached_name] = size
+            self.total_bytes += size
+
+    @staticmethod
+    def entry_name(key):
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+    def lookup(self, key):
+        name = self.entry_name(key)
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+        cached_path = os.path.join(self.cache_dir, name)
+        try:
+            # the modification time orders the entries again after a restart
+            os.utime(cached_path)
+        except OSError:
+            return None
+        return cached_path
+
+    def requested_before(self, key):
+        # True from the second time a body is sent
+        name = self.entry_name(key)
+        with self.lock:
+            if self.candidates.pop(name, None) is not None:
+                return True
+            self.candidates[name] = True
+            if len(self.candidates) > COMPRESSED_CACHE_CANDIDATES:
+                self.candidates.popitem(last=False)
+            return False
+
+    def temp_path(self, key):
+        return os.path.join(self.cache_dir, f"{self.entry_name(key)}.{id(key)}.tmp")
+
+    def add(self, key, temp_path):
+        name = self.entry_name(key)
+        size = os.path.getsize(temp_path)
+        with self.lock:
+            os.replace(temp_path, os.path.join(self.cache_dir, name))
+            self.total_bytes += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            while self.total_bytes > self.max_bytes and self.entries:
+                evicted_name, evicted_size = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                try:
+                    os.remove(os.path.join(self.cache_dir, evicted_name))
+                except OSError:
+                    pass
+
+
+class PeerConnection(object):
+
+    def __init__(self, address, timeout):
+        self.address = address
+        self.sock = create_connection(address, timeout=timeout)
+        self.reader = self.sock.makefile('rb')
+        self.idle_since = None
+        self.reused = False  # taken from the pool, the owner may have closed it while it was idle
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+class ConnectionPool(object):
+    # idle connections to other clients keyed by (IP address, TCP port), so consecutive requests to the same peer
+    # do not each pay for a new TCP connection
+
+    def __init__(self, timeout):
+        self.lock = Lock()
+        self.idle = {}  # address -> idle connections, most recently used last
+        self.timeout = timeout
+        self.sweeper = None
+
+    def acquire(self, address, reuse=True):
+        with self.lock:
+            idle_connections = self.idle.get(address, []) if reuse else []
+            while idle_connections:
+                connection = idle_connections.pop()
+                # an idle connection that is readable has been closed by the peer
+                if time.time() - connection.idle_since < POOL_IDLE_TIMEOUT and not select.select([connection.sock], [], [], 0)[0]:
+                    connection.reused = True
+                    return connection
+                connection.close()
+        return PeerConnection(address, self.timeout)
+
+    def release(self, connection):
+        # only connections whose replies have been read completely may be released
+        connection.idle_since = time.time()
+        with self.lock:
+            idle_connections = self.idle.setdefault(connection.address, [])
+            if len(idle_connections) < POOL_MAX_IDLE:
+                idle_connections.append(connection)
+                if self.sweeper is None:
+                    self.sweeper = Thread(target=self.close_expired_forever, daemon=True)
+                    self.sweeper.start()
+                return
+        connection.close()
+
+    def close_expired_forever(self):
+        # expired connections are closed as they expire rather than on the next acquire, so the peer does not keep
+        # serving connections that will not be used again
+        while True:
+            time.sleep(POOL_IDLE_TIMEOUT / 2)
+            with self.lock:
+                now = time.time()
+                for address in list(self.idle.keys()):
+                    for connection in self.idle[address]:
+                        if now - connection.idle_since >= POOL_IDLE_TIMEOUT:
+                            connection.close()
+                    self.idle[address] = [connection for connection in self.idle[address]
+                                          if now - connection.idle_since < POOL_IDLE_TIMEOUT]
+                    if not self.idle[address]:
+                        del self.idle[address]
+
+    def close_all(self):
+        with self.lock:
+            for idle_connections in self.idle.values():
+                for connection in idle_connections:
+                    connection.close()
+            self.idle = {}
+
+
+class TokenBucket(object):
+    # rate bytes per second, with at most UPLOAD_BURST seconds of it saved up. A send may take the balance below zero,
+    # the next one then waits until it is positive again, so sends of any size keep to the rate on average
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate * UPLOAD_BURST
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        # seconds until the next send may start
+        self.tokens = min(self.rate * UPLOAD_BURST, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens > 0 else -self.tokens / self.rate
+
+    def take(self, size):
+        self.tokens -= size
+
+
+class Upload(object):
+
+    def __init__(self, peer, length):
+        self.peer = peer  # name of the requesting client
+        self.weight = SMALL_UPLOAD_WEIGHT if length <= SMALL_UPLOAD_SIZE else 1
+
+
+class UploadScheduler(object):
+    # paces uploads to a limit for the whole uplink and limits per requesting client. Uploads waiting for a limit are
+    # granted by weighted fair queueing over peers: every grant moves its peer's virtual finish time on by size / weight
+    # and the upload with the earliest finish time that its limits allow goes next. Each peer gets an equal share
+    # however many connections it opens, and small uploads get ahead of large ones. Uploads that no limit applies to
+    # are not queued at all
+
+    def __init__(self):
+        self.condition = Condition()
+        self.global_bucket = None  # None while the uplink as a whole is not limited
+        self.peer_rates = {}  # client -> bytes per second
+        self.default_peer_rate = None  # limit of the clients without a rate of their own
+        self.peer_buckets = {}  # client -> TokenBucket, created when the client's first upload waits
+        self.virtual_time = 0  # finish time of the last grant
+        self.peer_finish = {}  # client -> finish time of its last grant
+        self.waiting = []  # (finish time, sequence number, upload) of every upload waiting for tokens
+        self.sequence = itertools.count()
+        self.sent = deque()  # (time, client, bytes) granted within the last RATE_WINDOW
+
+    def set_limit(self, peer, rate):
+        # peer None is the whole uplink and "*" every client without a limit of its own, rate None removes the limit
+        with self.condition:
+            if peer is None:
+                self.global_bucket = TokenBucket(rate) if rate is not None else None
+            else:
+                if peer == "*":
+                    self.default_peer_rate = rate
+                elif rate is None:
+                    self.peer_rates.pop(peer, None)
+                else:
+                    self.peer_rates[peer] = rate
+                self.peer_buckets = {}
+            self.condition.notify_all()
+
+    def limits(self):
+        # (limit of the whole uplink, limit of every client, client -> limit of its own)
+        with self.condition:
+            return self.global_bucket.rate if self.global_bucket is not None else None, self.default_peer_rate, dict(self.peer_rates)
+
+    def limited(self, peer):
+        return self.global_bucket is not None or self.peer_rates.get(peer, self.default_peer_rate) is not None
+
+    def limit_of(self, peer):
+        # the lowest limit that applies to uploads to peer, None without one
+        rates = [self.global_bucket.rate if self.global_bucket is not None else None,
+                 self.peer_rates.get(peer, self.default_peer_rate)]
+        rates = [rate for rate in rates if rate is not None]
+        return min(rates) if rates else None
+
+    def slice_size(self, upload):
+        # bytes to send between calls to acquire
+        return CHUNK_SIZE if self.limited(upload.peer) else UNLIMITED_SLICE
+
+    def peer_bucket(self, peer):
+        rate = self.peer_rates.get(peer, self.default_peer_rate)
+        if rate is None:
+            return None
+        if peer not in self.peer_buckets:
+            self.peer_buckets[peer] = TokenBucket(rate)
+        return self.peer_buckets[peer]
+
+    def acquire(self, upload, size):
+        # blocks until size more bytes of the upload may be sent
+        if not self.limited(upload.peer):
+            self.record(upload.peer, size)
+            return
+        with self.condition:
+            finish = max(self.virtual_time, self.peer_finish.get(upload.peer, 0)) + size / upload.weight
+            self.peer_finish[upload.peer] = finish
+            entry = (finish, next(self.sequence), upload)
+            self.waiting.append(entry)
+            try:
+                while True:
+                    delay = self.next_delay(entry)
+                    if delay == 0:
+                        break
+                    self.condition.wait(delay)
+            finally:
+                self.waiting.remove(entry)
+            for bucket in (self.global_bucket, self.peer_bucket(upload.peer)):
+                if bucket is not None:
+                    bucket.take(size)
+            self.virtual_time = max(self.virtual_time, finish)
+            self.record(upload.peer, size)
+            # the next upload in line may be allowed now
+            self.condition.notify_all()
+
+    def next_delay(self, entry):
+        # 0 once entry is the next upload its limits allow, otherwise how long to wait before checking again
+        now = time.monotonic()
+        if self.global_bucket is not None:
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                return global_delay
+        shortest = UPLOAD_BURST
+        for waiting in sorted(self.waiting):
+            bucket = self.peer_bucket(waiting[2].peer)
+            peer_delay = bucket.delay(now) if bucket is not None else 0
+            if peer_delay == 0:
+                if waiting is entry:
+                    return 0
+                # another upload goes first and is woken up to take its turn, this one is woken up after it
+                self.condition.notify_all()
+                return UPLOAD_BURST
+            shortest = min(shortest, peer_delay)
+        return shortest
+
+    def record(self, peer, size):
+        with self.condition:
+            now = time.monotonic()
+            self.sent.append((now, peer, size))
+            while self.sent and self.sent[0][0] < now - RATE_WINDOW:
+                self.sent.popleft()
+
+    def rates(self):
+        # client -> bytes per second granted over the last RATE_WINDOW
+        with self.condition:
+            now = time.monotonic()
+            while self.sent and self.sent[0][0] < now - RATE_WINDOW:
+                self.sent.popleft()
+            rates = {}
+            for _, peer, size in self.sent:
+                rates[peer] = rates.get(peer, 0) + size / RATE_WINDOW
+            return rates
+
+
+class RegistryLog(object):
+    # durable copy of the server's client table: every change is appended to a write-ahead log as the changed entry
+    # with its table version, and the table is periodically compacted into a snapshot that replaces the older logs.
+    # Files are named by table version - snapshot-<v>.jsonl holds the table at version v, wal-<v>.jsonl the changes
+    # after version v
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        self.log_file = None
+        self.buffer = []  # records waiting to be written
+        self.compaction = None  # thread writing a snapshot
+
+    def path(self, kind, version):
+        return os.path.join(self.data_dir, f"{kind}-{version:020d}.jsonl")
+
+    def files(self, kind):
+        # (version, path) of the files of one kind, oldest first
+        return sorted((int(name[len(kind) + 1:-len(".jsonl")]), os.path.join(self.data_dir, name))
+                      for name in os.listdir(self.data_dir) if name.startswith(kind + "-") and name.endswith(".jsonl"))
+
+    def load(self):
+        # returns the table version, the table and the (version, client) of every change replayed after the snapshot
+        version = 0
+        table = {}
+        snapshots = self.files("snapshot")
+        if snapshots:
+            with open(snapshots[-1][1]) as snapshot_file:
+                version = json.loads(snapshot_file.readline())["version"]
+                for line in snapshot_file:
+                    client, entry = json.loads(line)
+                    table[client] = entry
+        snapshot_version = version
+        changes = []
+        for _, log_path in self.files("wal"):
+            with open(log_path) as log_file:
+                for line in log_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last record was only partly written when the server stopped
+                        break
+                    if record["version"] > version:
+                        table[record["client"]] = record["entry"]
+                        version = record["version"]
+                        changes.append((version, record["client"]))
+        # the log of a version is empty or holds a partly written record, it is started afresh
+        open(self.path("wal", version), 'w').close()
+        self.rotate(version)
+        return version, table, snapshot_version, changes
+
+    def append(self, record):
+        self.buffer.append(json.dumps(record) + "\n")
+
+    def flush(self):
+        # the log is opened for appending, so the server's worker processes can write to it in version order
+        if self.buffer:
+            self.log_file.write("".join(self.buffer))
+            self.log_file.flush()
+            self.buffer = []
+
+    def commit(self):
+        # group commit: the records of one event loop iteration are written and synced together
+        self.flush()
+        os.fsync(self.log_file.fileno())
+
+    def rotate(self, version):
+        # changes after version go to a new log
+        if self.log_file is not None:
+            self.flush()
+            self.log_file.close()
+        self.log_file = open(self.path("wal", version), 'a')
+
+    def compacting(self):
+        return self.compaction is not None and self.compaction.is_alive()
+
+    def compact(self, version, table):
+        # table is a copy of the table at version. Later changes go to a new log while the snapshot is written in the
+        # background, the older logs are only removed once the snapshot is complete
+        self.rotate(version)
+        self.compaction = Thread(target=self.write_snapshot, args=(version, table), daemon=True)
+        self.compaction.start()
+
+    def write_snapshot(self, version, table):
+        try:
+            snapshot_path = self.path("snapshot", version)
+            with open(snapshot_path + ".tmp", 'w') as snapshot_file:
+                snapshot_file.write(json.dumps({"version": version, "clients": len(table)}) + "\n")
+                for client, entry in table.items():
+                    snapshot_file.write(json.dumps([client, entry]) + "\n")
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(snapshot_path + ".tmp", snapshot_path)
+            for kind in ("snapshot", "wal"):
+                for file_version, path in self.files(kind):
+                    if file_version < version:
+                        os.remove(path)
+        except Exception as e:
+            print(f"Error {e} in writing registry snapshot")
+
+
+class ChangeLock(object):
+    # serializes table changes across the server's worker processes. Entering it first catches the worker's replica up
+    # with the changes of the other workers, so every change is checked and applied against the latest table
+
+    def __init__(self, server, version_lock):
+        self.server = server
+        self.version_lock = version_lock
+
+    def __enter__(self):
+        self.server.database_lock.acquire()
+        while not self.version_lock.acquire(timeout=REPLICATION_POLL):
+            # the worker holding the lock may be waiting for this one to read the changes it sends
+            self.server.receive_replication()
+        self.server.catch_up()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.version_lock.release()
+        self.server.database_lock.release()
+
+
+class FileIndex(object):
+    # inverted index from file name to the online clients offering it, kept up to date entry by entry as the
+    # client table changes, with the names also kept sorted for prefix and glob lookups and ordered listings
+
+    def __init__(self):
+        self.lock = Lock()
+        self.owners = {}  # filename -> set of online clients offering it
+        self.sorted_names = []
+
+    def __len__(self):
+        return len(self.sorted_names)
+
+    @staticmethod
+    def indexed_names(entry):
+        if entry is None or not entry[ONLINE_STATUS_FIELD] or entry[FILE_NAMES_FIELD] is None:
+            return set()
+        return set(entry[FILE_NAMES_FIELD])
+
+    def update_client(self, client, old_entry, new_entry):
+        old_names = self.indexed_names(old_entry)
+        new_names = self.indexed_names(new_entry)
+        with self.lock:
+            for filename in old_names - new_names:
+                owners = self.owners[filename]
+                owners.discard(client)
+                if not owners:
+                    del self.owners[filename]
+                    del self.sorted_names[bisect.bisect_left(self.sorted_names, filename)]
+            for filename in new_names - old_names:
+                if filename not in self.owners:
+                    self.owners[filename] = set()
+                    bisect.insort(self.sorted_names, filename)
+                self.owners[filename].add(client)
+
+    def load(self, table):
+        # builds the index for a whole table at once, faster than adding the entries one by one
+        with self.lock:
+            self.owners = {}
+            for client, entry in table.items():
+                for filename in self.indexed_names(entry):
+                    self.owners.setdefault(filename, set()).add(client)
+            self.sorted_names = sorted(self.owners)
+
+    def owners_of(self, filename):
+        with self.lock:
+            return set(self.owners.get(filename, ()))
+
+    def match(self, pattern=""):
+        # names starting with pattern, or matching it as a glob if it contains wildcards, in sorted order
+        literal_prefix = re.split(r"[*?\[]", pattern, 1)[0]
+        is_glob = literal_prefix != pattern
+        matches = []
+        with self.lock:
+            # only the names sharing the pattern's literal prefix have to be looked at
+            for i in range(bisect.bisect_left(self.sorted_names, literal_prefix), len(self.sorted_names)):
+                filename = self.sorted_names[i]
+                if not filename.startswith(literal_prefix):
+                    break
+                if not is_glob or fnmatch.fnmatchcase(filename, pattern):
+                    matches.append((filename, sorted(self.owners[filename])))
+        return matches
+
+
+class RetransmitScheduler(object):
+    # one timer heap for every message that is waiting for an ACK, keyed by whatever identifies the reply
+
+    def __init__(self, interval=RETRY_INTERVAL, backoff=RETRY_BACKOFF, max_retries=MAX_RETRIES):
+        self.interval = interval
+        self.backoff = backoff
+        self.max_retries = max_retries
+        self.condition = Condition()
+        self.timers = []  # heap of (deadline, sequence number, key)
+        self.pending = {}  # key -> [sequence number, retries, resend callback, give up callback]
+        self.sequence = itertools.count()
+
+    def schedule(self, key, resend, give_up=None):
+        with self.condition:
+            sequence = next(self.sequence)
+            self.pending[key] = [sequence, 0, resend, give_up]
+            heapq.heappush(self.timers, (time.monotonic() + self.interval, sequence, key))
+            self.condition.notify()
+
+    def cancel(self, key):
+        with self.condition:
+            return self.pending.pop(key, None) is not None
+
+    def scheduled(self, key):
+        with self.condition:
+            return key in self.pending
+
+    def next_delay(self):
+        # seconds until the next retransmission is due, None if nothing is waiting for an ACK
+        with self.condition:
+            while self.timers and self.timers[0][2] not in self.pending:
+                heapq.heappop(self.timers)
+            if not self.timers:
+                return None
+            return max(0.0, self.timers[0][0] - time.monotonic())
+
+    def run_forever(self):
+        # sleeps until the earliest retransmission is due, schedule() wakes it up for earlier deadlines
+        while True:
+            with self.condition:
+                self.condition.wait(self.next_delay())
+            self.run_due()
+
+    def run_due(self):
+        due = []
+        with self.condition:
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                deadline, sequence, key = heapq.heappop(self.timers)
+                entry = self.pending.get(key)
+                if entry is None or entry[0] != sequence:
+                    # acknowledged, or replaced by a newer message for the same key
+                    continue
+                entry[1] += 1
+                if entry[1] > self.max_retries:
+                    del self.pending[key]
+                    due.append((entry[3], None))
+                else:
+                    heapq.heappush(self.timers, (now + self.interval * self.backoff ** entry[1], sequence, key))
+                    due.append((entry[2], entry[1]))
+        # callbacks run outside the lock so they are free to schedule or cancel
+        for callback, retries in due:
+            if callback is None:
+                continue
+            try:
+                if retries is None:
+                    callback()
+                else:
+                    callback(retries)
+            except Exception as e:
+                # a failed resend is retried at its next deadline, the thread keeps serving every other message
+                print(f"< Error {e} in retransmission >")
+
+
+class Segment(object):
+
+    def __init__(self, offset, end):
+        self.offset = offset
+        self.end = end  # exclusive, may be moved down when the tail of the range is handed to another owner
+        self.received = 0
+
+    def remaining(self):
+        return self.end - self.offset - self.received
+
+
+class SegmentedDownload(object):
+    # byte ranges of one file shared by the threads that fetch it, each thread pulls its next range from here so
+    # faster owners end up fetching more of the file. Ranges start and end on manifest chunk boundaries so that
+    # every chunk is received, and verified, by one thread
+
+    def __init__(self, manifest, segment_size, checkpoint_path, saved_ranges=()):
+        self.condition = Condition()
+        self.manifest = manifest
+        self.file_size = manifest["size"]
+        self.chunk_size = manifest["chunk_size"]
+        self.checkpoint_path = checkpoint_path
+        self.saved_ranges = []  # sorted, non overlapping [start, end) ranges already verified, written and flushed
+        for start, end in saved_ranges:
+            self.add_saved_range(start, end)
+        self.saved_at_start = sum(end - start for start, end in self.saved_ranges)  # resumed or copied from local files
+        self.started = time.perf_counter()
+        self.pending = deque()
+        missing_start = 0
+        for start, end in self.saved_ranges + [[self.file_size, self.file_size]]:
+            for offset in range(missing_start, start, segment_size):
+                self.pending.append(Segment(offset, min(offset + segment_size, start)))
+            missing_start = end
+        self.in_flight = set()
+
+    def saved_bytes(self):
+        with self.condition:
+            return sum(end - start for start, end in self.saved_ranges)
+
+    def add_saved_range(self, start, end):
+        if start >= end:
+            return
+        merged = []
+        for saved_start, saved_end in self.saved_ranges:
+            if saved_end < start or saved_start > end:
+                merged.append([saved_start, saved_end])
+            else:
+                start, end = min(start, saved_start), max(end, saved_end)
+        merged.append([start, end])
+        self.saved_ranges = sorted(merged)
+
+    def save(self, file, start, end):
+        # the bytes must reach the disk before the checkpoint claims them
+        file.flush()
+        os.fsync(file.fileno())
+        with self.condition:
+            self.add_saved_range(start, end)
+            checkpoint = {"size": self.file_size, "digest": self.manifest["digest"], "ranges": self.saved_ranges}
+            with open(self.checkpoint_path + ".tmp", 'w') as checkpoint_file:
+                json.dump(checkpoint, checkpoint_file)
+            os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def next_segment(self):
+        with self.condition:
+            while True:
+                if self.pending:
+                    segment = self.pending.popleft()
+                    self.in_flight.add(segment)
+                    return segment
+                if not self.in_flight:
+                    return None
+                # nothing left to hand out: take over the second half of the range with the most bytes outstanding
+                victim = max(self.in_flight, key=lambda in_flight_segment: in_flight_segment.remaining())
+                middle = victim.end - victim.remaining() // 2
+                middle = -(-middle // self.chunk_size) * self.chunk_size
+                if victim.remaining() >= MIN_SPLIT_SIZE and middle < victim.end:
+                    segment = Segment(middle, victim.end)
+                    victim.end = middle
+                    self.in_flight.add(segment)
+                    return segment
+                # wait in case an in-flight range fails and has to be fetched again
+                self.condition.wait()
+
+    def claim(self, segment, length):
+        # returns how many of the next length bytes still belong to this segment and advances it past them
+        with self.condition:
+            length = max(0, min(length, segment.remaining()))
+            segment.received += length
+            return length
+
+    def complete(self, segment):
+        with self.condition:
+            self.in_flight.discard(segment)
+            self.condition.notify_all()
+
+    def take_all(self):
+        # hands out every pending range at once, for a single connection that requests them back to back
+        with self.condition:
+            segments = list(self.pending)
+            self.pending.clear()
+            self.in_flight.update(segments)
+            return segments
+
+    def fail(self, segment, verified_position):
+        # everything from the last verified chunk boundary is fetched again
+        with self.condition:
+            self.in_flight.discard(segment)
+            if verified_position < segment.end:
+                self.pending.appendleft(Segment(verified_position, segment.end))
+            self.condition.notify_all()
+
+    def finished(self):
+        with self.condition:
+            return not self.pending and not self.in_flight
+
 
 class Client(object):
 
-    def __init__(self, name, udp_port, tcp_port):
+    def __init__(self, name, udp_port, tcp_port, tcp_backlog=DEFAULT_TCP_BACKLOG, max_transfers=DEFAULT_MAX_TRANSFERS,
+                 connection_timeout=DEFAULT_CONNECTION_TIMEOUT, compressed_cache_size=DEFAULT_COMPRESSED_CACHE_SIZE,
+                 stats_file=None, profile_path=None, upload_limit=None, peer_upload_limit=None, codecs=()):
         self.client_name = name
         self.client_udp_port = udp_port
         self.client_tcp_port = tcp_port
@@ -34,10 +1092,37 @@ class Client(object):
         self.server_port = None
         self.file_names = None
         self.directory = None
+        self.hash_cache = None  # manifests of the files in directory
+        self.compressed_cache = None  # compressed bodies of files in directory sent to other clients
+        self.compressed_cache_size = compressed_cache_size
+        # (path, size, mtime) -> {codec: (compressed size / size of the file's samples, seconds to compress a byte)}
+        self.codec_samples = {}
+        self.codecs = list(codecs)  # codecs this client accepts for its downloads, none unless it asks for compression
         self.stop_tcp_listening = False
+        self.tcp_backlog = tcp_backlog
+        self.max_transfers = max_transfers
+        self.connection_timeout = connection_timeout
+        self.peer_connections = ConnectionPool(connection_timeout)
+        self.idle_peer_sockets = set()  # served connections waiting for the requester's next request
+        self.idle_peer_lock = Lock()
+        self.upload_scheduler = UploadScheduler()
+        self.upload_scheduler.set_limit(None, upload_limit)
+        self.upload_scheduler.set_limit("*", peer_upload_limit)
         # dictionary of dictionaries - client_name: {IP address, TCP port, UDP port, online status, file name}
         self.client_database = {}
-        self.retry_exit = False  # exit flag to kill the retry thread once ACK is received
+        self.file_index = FileIndex()  # filename -> online owners, follows every change to client_database
+        self.table_version = 0  # version of the server's client table that client_database reflects
+        self.resync_requested_at = None  # time of the last full table request, None once the table is received
+        self.held_deltas = {}  # version -> changed entries of broadcasts that arrived before an earlier version
+        # control requests carry a REQUEST_ID that the server echoes, listen_to_broadcast routes each reply to the
+        # (future, reply callback) waiting for it; ids start at a random value so a restarted client on the same port
+        # does not collide with replies the server cached for its previous run
+        self.request_ids = itertools.count(random.getrandbits(31))
+        self.pending_requests = {}  # REQUEST_ID -> (future, reply callback, time sent)
+        self.retransmits = RetransmitScheduler()
+        self.metrics = Metrics()
+        self.stats_file = stats_file  # the metrics are written here every STATS_INTERVAL if set
+        self.profiler = Profiler(profile_path)
 
     def set_dir(self, directory):
         if self.client_name in list(self.client_database.keys()) and not self.client_database[self.client_name][ONLINE_STATUS_FIELD]:
@@ -45,6 +1130,8 @@ class Client(object):
         else:
             if (os.path.exists(directory)):
                 self.directory = os.path.abspath(directory)
+                self.hash_cache = HashCache(self.directory)
+                self.compressed_cache = CompressedCache(self.directory, self.compressed_cache_size * 1024 * 1024)
                 print(f">>> [Successfully set {self.directory} as the directory for searching offered files.]")
             else:
                 print(f">>> [setdir failed: {directory} does not exist.]")
@@ -58,69 +1145,220 @@ class Client(object):
                                ONLINE_STATUS_FIELD: True}
             new_client = {self.client_name: new_client_info}
 
-            self.client_udp_socket.sendto(json.dumps({"REGISTER": new_client}).encode(),
-                                          (self.server_ip, int(self.server_port)))
+            def on_reply(info):
+                operation = list(info.keys())[0]
+                if operation in ("NEW_REGISTRATION", "RE_REGISTRATION"):
+                    if "since" in info[operation]:
+                        # only the entries that changed after the version the client already has
+                        self.update_client_database(info[operation]["clients"])
+                        self.table_version = info[operation]["version"]
+                    else:
+                        self.receive_full_table(info[operation])
 
-            reply_from_server, server_address = self.client_udp_socket.recvfrom(2048)
+            try:
+                # the table version lets the server send a reregistering client only the changes it missed
+                info = self.send_request("REGISTER", new_client, on_reply, {"VERSION": self.table_version}).result()
+            except TimeoutError:
+                print(">>> [Server not responding]")
+                sys.exit()
+            operation = list(info.keys())[0]
 
-            if reply_from_server.decode() != "ACK":
-                if reply_from_server.decode() == "Invalid":
-                    print(">>> [Registration rejected: Client username already in use.]")
-                    sys.exit()
-                else:
-                    info = json.loads(reply_from_server.decode())
-                    operation = list(info.keys())[0]
-
-                    if operation == "NEW_REGISTRATION":
-                        self.update_client_database(info[operation])
-                        print(">>> [Welcome, You are registered.]")
-                        self.client_udp_socket.sendto("ACK".encode(), (server_ip, int(server_port)))
-                    elif operation == "RE_REGISTRATION":
-                        self.update_client_database(info[operation])
-                        print(">>> [You are already registered.]")
-                        self.client_udp_socket.sendto("ACK".encode(), (server_ip, int(server_port)))
+            if operation == "INVALID":
+                print(">>> [Registration rejected: Client username already in use.]")
+                sys.exit()
+            elif operation == "NEW_REGISTRATION":
+                print(">>> [Welcome, You are registered.]")
+            elif operation == "RE_REGISTRATION":
+                print(">>> [You are already registered.]")
         except Exception as e:
             print(f">>> [Error in registration]: {e}")
             traceback.print_exc()
             sys.exit()
 
+    def send_request(self, operation, payload, on_reply=None, extra_fields=None):
+        # returns a Future resolved with the server's reply, or failed with TimeoutError once every retry is used up.
+        # on_reply runs on the listen_to_broadcast thread before the future resolves, so table changes it makes are
+        # ordered with the broadcasts around them
+        request_id = next(self.request_ids)
+        message = {operation: payload, "REQUEST_ID": request_id}
+        if extra_fields is not None:
+            message.update(extra_fields)
+        message_to_send = json.dumps(message).encode()
+        future = Future()
+        self.pending_requests[request_id] = (future, on_reply, time.perf_counter())
+        self.metrics.increment(f"requests.{operation}")
+
+        def resend(retries):
+            print(f"Retrying {retries} times")
+            self.metrics.increment("requests.retries")
+            self.send_to_server(message_to_send)
+
+        def give_up():
+            if self.pending_requests.pop(request_id, None) is not None:
+                self.metrics.increment("requests.timeouts")
+                future.set_exception(TimeoutError(f"no reply to {operation}"))
+
+        self.retransmits.schedule(request_id, resend, give_up)
+        try:
+            self.send_to_server(message_to_send)
+        except OSError as e:
+            # nothing reached the server, so nothing is retried or waited for
+            self.retransmits.cancel(request_id)
+            self.pending_requests.pop(request_id, None)
+            self.metrics.increment("requests.failed")
+            future.set_exception(e)
+        return future
+
+    def send_to_server(self, message_to_send):
+        # requests too large for one datagram, such as offers of many files, are sent over TCP to the server's port
+        # with the same number. The reply still comes back over UDP
+        if len(message_to_send) <= UDP_PAYLOAD_LIMIT:
+            self.client_udp_socket.sendto(message_to_send, (self.server_ip, int(self.server_port)))
+            return
+        data = zlib.compress(message_to_send)
+        with create_connection((self.server_ip, int(self.server_port)), timeout=self.connection_timeout) as request_socket:
+            send_message(request_socket, {"REQUEST": {"udp_port": int(self.client_udp_port), "length": len(data), "encoding": "zlib"}})
+            request_socket.sendall(data)
+        self.metrics.increment("requests.over_tcp")
+
     def update_client_database(self, client_info_in_server):
         for client in client_info_in_server.keys():
+            self.file_index.update_client(client, self.client_database.get(client), client_info_in_server[client])
             self.client_database[client] = client_info_in_server[client]
 
+    def update_own_entry(self, field, value):
+        entry = dict(self.client_database[self.client_name])
+        entry[field] = value
+        self.update_client_database({self.client_name: entry})
+
+    def replace_client_database(self, client_info_in_server, version):
+        self.client_database = dict(client_info_in_server)
+        self.file_index = FileIndex()
+        self.file_index.load(self.client_database)
+        self.table_version = version
+        self.resync_requested_at = None
+        self.held_deltas = {held_version: clients for held_version, clients in self.held_deltas.items() if held_version > version}
+        self.apply_held_deltas()
+        if not self.held_deltas:
+            self.retransmits.cancel(REORDER_KEY)
+
+    def receive_full_table(self, full_table):
+        # tables too large for one datagram only announce their version and are fetched over TCP
+        if full_table.get("snapshot"):
+            full_table = self.fetch_snapshot(version=full_table["version"])
+        if full_table["version"] >= self.table_version:
+            self.replace_client_database(full_table["table"], full_table["version"])
+            return True
+        return False
+
+    def fetch_snapshot(self, client=None, version=None):
+        # the server serves its table on the TCP port with the same number as its UDP port, a client name limits the
+        # snapshot to that client's entry and version is the table version the snapshot should have at least
+        with create_connection((self.server_ip, int(self.server_port)), timeout=self.connection_timeout) as snapshot_socket, \
+                snapshot_socket.makefile('rb') as reader:
+            send_message(snapshot_socket, {"SNAPSHOT": client, "VERSION": version})
+            header = read_message(reader)
+            data = reader.read(header["SNAPSHOT"]["length"])
+        return decode_snapshot(data)
+
+    def apply_table_delta(self, client_info_in_server, version):
+        # deltas are applied strictly in version order. One that arrives early is held, the server's workers may send
+        # the versions before it by other paths, and the full table is requested if the gap is not filled in time
+        if version <= self.table_version:
+            return False
+        self.held_deltas[version] = client_info_in_server
+        applied = self.apply_held_deltas()
+        if not self.held_deltas:
+            self.retransmits.cancel(REORDER_KEY)
+        elif not self.retransmits.scheduled(REORDER_KEY):
+            self.retransmits.schedule(REORDER_KEY, lambda retries: self.request_resync(), self.request_resync)
+        return applied
+
+    def apply_held_deltas(self):
+        applied = False
+        while self.table_version + 1 in self.held_deltas:
+            client_info_in_server = self.held_deltas.pop(self.table_version + 1)
+            if client_info_in_server is not None:
+                self.update_client_database(client_info_in_server)
+            self.table_version += 1
+            applied = True
+        return applied
+
+    def fast_forward_table_version(self, version):
+        # the server does not broadcast a client's own changes back to it, the ACK carries the new version instead
+        self.apply_table_delta(None, version)
+
+    def request_resync(self):
+        if self.resync_requested_at is not None and time.time() - self.resync_requested_at < RESYNC_TIMEOUT:
+            return
+        self.resync_requested_at = time.time()
+        self.client_udp_socket.sendto(json.dumps({"RESYNC": self.client_name}).encode(),
+                                      (self.server_ip, int(self.server_port)))
+
     def listen_to_broadcast(self):
+        # the only reader of the UDP socket: replies go to the request waiting for them, broadcasts update the table
         while True:
-            message, server_address = self.client_udp_socket.recvfrom(2048)
-            if message.decode() != "ACK" and message.decode() != "Invalid":
-                info = json.loads(message.decode())
-                operation = list(info.keys())[0]
+            message, server_address = self.client_udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
+            try:
+                self.dispatch(message)
+            except Exception as e:
+                print(f">>> [Error in handling message from server]: {e}")
+                traceback.print_exc()
+
+    def dispatch(self, message):
+        info = json.loads(message.decode())
+        request_id = info.pop("REQUEST_ID", None)
+        operation = list(info.keys())[0]
+        self.metrics.increment(f"messages.{operation}")
+
+        if request_id is not None:
+            if operation in ("NEW_REGISTRATION", "RE_REGISTRATION"):
+                # acknowledged every time, the server resends the reply until the ACK gets through
+                self.client_udp_socket.sendto("ACK".encode(), (self.server_ip, int(self.server_port)))
+            self.retransmits.cancel(request_id)
+            pending_request = self.pending_requests.pop(request_id, None)
+            if pending_request is None:
+                # duplicate reply to a retransmitted request
+                return
+            future, on_reply, sent_at = pending_request
+            self.metrics.observe("requests.round_trip_ms", (time.perf_counter() - sent_at) * 1000)
+            try:
+                if on_reply is not None:
+                    on_reply(info)
+            finally:
+                future.set_result(info)
+
+        elif operation == "BROADCAST":
+            delta = info[operation]
+            if "snapshot" in delta and delta["version"] > self.table_version:
+                # the changed entry did not fit in a datagram. If the table moved on while fetching, the entry may be
+                # newer than the announced version, which is harmless: the broadcasts in between are applied after it
+                # in version order and the client's latest entry ends up last
+                snapshot = self.fetch_snapshot(delta["snapshot"], delta["version"])
+                delta = {"version": delta["version"], "clients": snapshot["table"]}
+            if self.apply_table_delta(delta.get("clients"), delta["version"]):
+                print()
+                print(">>> [Client table updated.]")
+                print(">>> ", end='', flush=True)
 
-                if operation == "BROADCAST":
-                    for client in info[operation].keys():
-                        self.client_database[client] = info[operation][client]
-                    print()
-                    print(">>> [Client table updated.]")
-                    print(">>> ", end='', flush=True)
+        elif operation == "FULL_TABLE":
+            if self.receive_full_table(info[operation]):
+                print()
+                print(">>> [Client table updated.]")
+                print(">>> ", end='', flush=True)
 
     def deregister(self):
         if self.client_name in list(self.client_database.keys()) and not self.client_database[self.client_name][ONLINE_STATUS_FIELD]:
             print(">>> [Client is already offline/deregistered.]")
         else:
             try:
-                self.client_udp_socket.sendto(json.dumps({"DEREGISTER": self.client_name}).encode(),
-                                              (server_ip, int(server_port)))
-                retry_thread = Thread(target=self.retry_udp, args=(json.dumps({"DEREGISTER": self.client_name}),))
-                retry_thread.start()
-                reply_from_server, server_address = self.client_udp_socket.recvfrom(2048)
-                if reply_from_server.decode() == "ACK":
-                    self.retry_exit = True
-                    retry_thread.join()
-                    self.retry_exit = False
-                    self.client_database[self.client_name][ONLINE_STATUS_FIELD] = False
+                try:
+                    self.send_request("DEREGISTER", self.client_name).result()
+                    self.update_own_entry(ONLINE_STATUS_FIELD, False)
                     self.stop_tcp_listening = True
+                    self.peer_connections.close_all()
                     print(">>> [You are Offline. Bye.]")
-
-                if self.client_database[self.client_name][ONLINE_STATUS_FIELD] is True and self.stop_tcp_listening is False:
+                except TimeoutError:
                     print(">>> [Server not responding]")
                     sys.exit(">>> [Exiting]")
 
@@ -144,197 +1382,1187 @@ class Client(object):
             else:
                 current_filenames = set(file_names)
 
+            # offered files are hashed now, so their manifests are ready when requested and their chunks can be
+            # copied into later downloads
+            for filename in file_names:
+                try:
+                    self.hash_cache.manifest(os.path.join(self.directory, os.path.basename(filename)))
+                except OSError:
+                    print(f">>> [{filename} not found in {self.directory}.]")
+            self.hash_cache.save()
+
+            def on_reply(info):
+                self.update_own_entry(FILE_NAMES_FIELD, current_filenames)
+                self.fast_forward_table_version(info["ACK"]["version"])
+
             # Converting set to list of file names before sending because 'set' is not json serializable
-            self.client_udp_socket.sendto(json.dumps({"SET_FILENAMES": {self.client_name: list(current_filenames)}}).encode(),
-                                          (self.server_ip, int(self.server_port)))
-
-            retry_thread = Thread(target=self.retry_udp, args=(json.dumps({"SET_FILENAMES": {self.client_name: list(current_filenames)}}),))
-            retry_thread.start()
-            reply_from_server, server_address = self.client_udp_socket.recvfrom(2048)
-            if reply_from_server.decode() == "ACK":
-                self.retry_exit = True
-                retry_thread.join()
-                self.retry_exit = False
-                self.client_database[self.client_name][FILE_NAMES_FIELD] = current_filenames
+            try:
+                self.send_request("SET_FILENAMES", {self.client_name: list(current_filenames)}, on_reply).result()
                 print(">>> [Offer Message Received By Server]")
-
-            if self.client_database[self.client_name][FILE_NAMES_FIELD] is None:
+            except TimeoutError:
                 print(">>> [No ACK from Server, please try again later.]")
 
-    def retry_udp(self, json_message):
-        start_time = time.time()
-        retries = 0
-        while True:
-            if round(time.time() - start_time, 1) > 1 or retries > 2:
-                break
-
-            if self.retry_exit:
-                break
-
-            if round(time.time() - start_time, 1) == 0.5 or round(time.time() - start_time, 1) == 1:
-                retries += 1
-                print(f"Retrying {retries} times")
-                self.client_udp_socket.sendto(json_message.encode(), (self.server_ip, int(self.server_port)))
-
-    def file_list(self):
+    def file_list(self, page=1):
         if self.client_name in list(self.client_database.keys()) and not self.client_database[self.client_name][ONLINE_STATUS_FIELD]:
             print(">>> [Client not online, operation allowed.]")
         else:
             if not self.check_no_files_in_db():
-                print(f"{FILENAME_STRING:15} {OWNER_STRING:15} {IP_ADDRESS_STRING:15} {TCP_PORT_STRING:15}")
-                for client in self.client_database.keys():
-                    if self.client_database[client][FILE_NAMES_FIELD] is not None and self.client_database[client][ONLINE_STATUS_FIELD]:
-                        for filename in self.client_database[client][FILE_NAMES_FIELD]:
-                            print(f"{filename:15} {client:15} {self.client_database[client][IP_ADDRESS_FIELD]:15} {self.client_database[client][TCP_PORT_FIELD]:15}")
+                self.print_file_rows(self.file_index.match(), page)
             else:
                 print(">>> [No files available for download at the moment.]")
 
-    def check_no_files_in_db(self):
-        if len(self.client_database) == 0:
-            return True
+    def search(self, pattern, page=1):
+        if self.client_name in list(self.client_database.keys()) and not self.client_database[self.client_name][ONLINE_STATUS_FIELD]:
+            print(">>> [Client not online, operation allowed.]")
+        else:
+            matches = self.file_index.match(pattern)
+            if matches:
+                self.print_file_rows(matches, page)
+            else:
+                print(f">>> [No files matching {pattern}.]")
 
-        no_files_in_db = True
-        for client in self.client_database.keys():
-            if self.client_database[client][FILE_NAMES_FIELD] is not None:
-                no_files_in_db = False
-        return no_files_in_db
+    def print_file_rows(self, matches, page):
+        # matches are (filename, sorted owners) in filename order, one row is printed per owner
+        row_count = sum(len(owners) for filename, owners in matches)
+        page_count = (row_count + PAGE_SIZE - 1) // PAGE_SIZE
+        if page < 1 or page > page_count:
+            print(f">>> [Invalid page {page}, there are {page_count} pages.]")
+            return
+        first_row = (page - 1) * PAGE_SIZE
+        row = 0
+        print(f"{FILENAME_STRING:15} {OWNER_STRING:15} {IP_ADDRESS_STRING:15} {TCP_PORT_STRING:15}")
+        for filename, owners in matches:
+            if row + len(owners) <= first_row:
+                row += len(owners)
+                continue
+            for client in owners:
+                if first_row <= row < first_row + PAGE_SIZE:
+                    print(f"{filename:15} {client:15} {self.client_database[client][IP_ADDRESS_FIELD]:15} {self.client_database[client][TCP_PORT_FIELD]:15}")
+                row += 1
+            if row >= first_row + PAGE_SIZE:
+                break
+        if page_count > 1:
+            print(f">>> [Page {page} of {page_count}, {row_count} files.]")
+
+    def stats(self):
+        print(json.dumps(self.metrics.snapshot(), indent=2))
+        # the stats file and profile are brought up to date as well
+        self.write_stats()
+        if self.profiler.path is not None:
+            print(f">>> [Profile written to {self.profiler.path}]")
+
+    def write_stats(self):
+        try:
+            if self.stats_file is not None:
+                self.metrics.dump(self.stats_file)
+            self.profiler.dump()
+        except Exception as e:
+            print(f">>> [Error in writing stats]: {e}")
+
+    def write_stats_forever(self):
+        while True:
+            time.sleep(STATS_INTERVAL)
+            self.write_stats()
+
+    def check_no_files_in_db(self):
+        return len(self.file_index) == 0
 
     def listen_for_file_request(self):
+        self.client_tcp_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         self.client_tcp_socket.bind(('', int(self.client_tcp_port)))
-        self.client_tcp_socket.listen(1)
-        while not self.stop_tcp_listening:
-            connectionSocket, addr = self.client_tcp_socket.accept()
-            print(f"< Accepting connection request from {addr[0]}. >")
-            message = json.loads(connectionSocket.recv(2048).decode())
-            key = list(message.keys())[0]
-            if key == "REQUEST":
+        self.client_tcp_socket.listen(self.tcp_backlog)
+        # accept() wakes up periodically so that stop_tcp_listening is noticed even when no peer connects
+        self.client_tcp_socket.settimeout(ACCEPT_POLL_INTERVAL)
+        # a transfer slot is taken for each request while it is served, so at most max_transfers are served at once.
+        # Open connections take a connection slot each, while they are idle between requests as well. Once those run
+        # out, the idle connections are closed to make room for the new peer and further peers wait in the backlog
+        transfer_slots = BoundedSemaphore(self.max_transfers)
+        connection_slots = BoundedSemaphore(self.max_transfers * PEER_CONNECTIONS_PER_TRANSFER)
+        executor = ThreadPoolExecutor(max_workers=self.max_transfers * PEER_CONNECTIONS_PER_TRANSFER, thread_name_prefix="upload")
+        try:
+            while not self.stop_tcp_listening:
                 try:
-                    file = self.directory.strip() + "/" + message[key][0].strip()
-                    print(f"< Transferring {message[key][0]}... >")
-                    with open(file, 'r') as file:
-                        data = file.read().replace('\n', 'NEXT')
-                    connectionSocket.send(data.encode())
-                    print(f"< {message[key][0]} transferred successfully! >")
-                except Exception as e:
-                    print(f"< Error {e} in sending file >")
-                    traceback.print_exc()
-                    print(">>> ", end='', flush=True)
-                    connectionSocket.send("ERROR".encode())
-            print(f"< Connection with client {message[key][1]} closed>")
+                    connectionSocket, addr = self.client_tcp_socket.accept()
+                except timeout:
+                    continue
+                while not connection_slots.acquire(blocking=False):
+                    self.close_idle_peer_connections()
+                    if connection_slots.acquire(timeout=ACCEPT_POLL_INTERVAL):
+                        break
+                connectionSocket.settimeout(self.connection_timeout)
+                executor.submit(self.serve_peer_connection, connectionSocket, addr, transfer_slots, connection_slots)
+        finally:
+            self.client_tcp_socket.close()
+            # graceful shutdown: no new peers are accepted but transfers already in progress are completed
+            self.close_idle_peer_connections()
+            executor.shutdown(wait=True)
+
+    def close_idle_peer_connections(self):
+        # the threads serving them see the connection closed by the requester
+        with self.idle_peer_lock:
+            for idle_socket in self.idle_peer_sockets:
+                try:
+                    idle_socket.shutdown(SHUT_RDWR)
+                except OSError:
+                    pass
+            self.idle_peer_sockets = set()
+
+    def serve_peer_connection(self, connectionSocket, addr, transfer_slots, connection_slots):
+        requester = addr[0]
+        self.metrics.increment("connections.accepted")
+        self.metrics.adjust("connections.active", 1)
+        try:
+            print(f"< Accepting connection request from {addr[0]}. >")
+            with connectionSocket, connectionSocket.makefile('rb') as reader:
+                # a connection carries any number of requests, answered in the order they arrive, until the requester
+                # closes it or it stays idle for PEER_IDLE_TIMEOUT
+                while not self.stop_tcp_listening:
+                    connectionSocket.settimeout(PEER_IDLE_TIMEOUT)
+                    with self.idle_peer_lock:
+                        self.idle_peer_sockets.add(connectionSocket)
+                    try:
+                        message = read_message(reader)
+                    except OSError:
+                        message = None
+                    with self.idle_peer_lock:
+                        if connectionSocket not in self.idle_peer_sockets:
+                            # closed by close_idle_peer_connections, a request read meanwhile is not answered
+                            message = None
+                        self.idle_peer_sockets.discard(connectionSocket)
+                    if message is None:
+                        break
+                    connectionSocket.settimeout(self.connection_timeout)
+                    key = list(message.keys())[0]
+                    requester = f"client {message[key][1]}"
+                    transfer_slots.acquire()
+                    try:
+                        if key == "MANIFEST":
+                            # [filename, requesting client]
+                            with self.profiler:
+                                self.send_manifest(connectionSocket, message[key][0].strip())
+                        elif key == "REQUEST":
+                            try:
+                                # [filename, requesting client] optionally followed by the byte offset and length to send
+                                # and the codecs the requester accepts
+                                offset = message[key][2] if len(message[key]) > 2 else 0
+                                length = message[key][3] if len(message[key]) > 3 else None
+                                codecs = message[key][4] if len(message[key]) > 4 else []
+                                with self.profiler:
+                                    self.send_file(connectionSocket, message[key][0].strip(), offset, length, codecs,
+                                                   message[key][1])
+                            except ConnectionError:
+                                # the requester stops reading early when another owner takes over the rest of its range
+                                print(f"< Client {message[key][1]} stopped reading {message[key][0]} >")
+                                break
+                            except Exception as e:
+                                # the rest of the body is missing, so the connection cannot carry further replies
+                                print(f"< Error {e} in sending file >")
+                                traceback.print_exc()
+                                print(">>> ", end='', flush=True)
+                                break
+                    finally:
+                        transfer_slots.release()
+                print(f"< Connection with {requester} closed>")
+                print(">>> ", end='', flush=True)
+        except Exception as e:
+            print(f"< Error {e} on connection from {addr[0]} >")
             print(">>> ", end='', flush=True)
-            connectionSocket.close()
+        finally:
+            with self.idle_peer_lock:
+                self.idle_peer_sockets.discard(connectionSocket)
+            self.metrics.adjust("connections.active", -1)
+            connection_slots.release()
+
+    def send_manifest(self, connectionSocket, filename):
+        try:
+            manifest = self.hash_cache.manifest(os.path.join(self.directory, os.path.basename(filename)))
+            self.hash_cache.save()
+        except OSError as e:
+            send_message(connectionSocket, {"ERROR": str(e)})
+            return
+        send_message(connectionSocket, {"MANIFEST": manifest})
+
+    def send_file(self, connectionSocket, filename, offset=0, length=None, codecs=(), requester=None):
+        # basename keeps requests from reaching outside the offered directory
+        file_path = os.path.join(self.directory.strip(), os.path.basename(filename))
+        try:
+            file = open(file_path, 'rb')
+        except OSError as e:
+            # the requester can go on with its next request on the same connection
+            send_message(connectionSocket, {"ERROR": str(e)})
+            print(f"< Error {e} in sending file >")
+            return
+        with file:
+            file_size = os.fstat(file.fileno()).st_size
+            if offset < 0 or offset > file_size:
+                send_message(connectionSocket, {"ERROR": f"offset {offset} outside of {filename}"})
+                return
+            if length is None or length > file_size - offset:
+                length = file_size - offset
+            codec = self.choose_codec(file_path, file, codecs, requester) if codecs and length >= MIN_COMPRESS_SIZE else None
+            send_message(connectionSocket, {"FILE": {"name": filename, "size": file_size, "offset": offset, "length": length,
+                                                     "codec": codec}})
+            if length == 0:
+                return
+            if length == file_size:
+                print(f"< Transferring {filename} ({file_size} bytes{f', {codec}' if codec else ''})... >")
+            else:
+                print(f"< Transferring bytes {offset}-{offset + length} of {filename}{f' ({codec})' if codec else ''}... >")
+            started = time.perf_counter()
+            upload = Upload(requester, length)
+            self.metrics.adjust("uploads.active", 1)
+            try:
+                if codec is None:
+                    self.send_range(connectionSocket, file, offset, length, upload)
+                else:
+                    self.send_compressed(connectionSocket, file, offset, length, codec, upload)
+            except BaseException:
+                self.metrics.increment("uploads.failed")
+                raise
+            finally:
+                self.metrics.adjust("uploads.active", -1)
+        self.record_transfer("uploads", length, time.perf_counter() - started)
+        print(f"< {filename} transferred successfully! >")
+
+    def record_transfer(self, kind, length, duration):
+        self.metrics.increment(f"{kind}.completed")
+        self.metrics.observe(f"{kind}.bytes", length)
+        self.metrics.observe(f"{kind}.duration_ms", duration * 1000)
+        self.metrics.observe(f"{kind}.throughput_mb_s", length / max(duration, 1e-6) / (1024 * 1024))
+
+    def send_range(self, connectionSocket, file, offset, length, upload):
+        # sendfile() is zero-copy where the platform supports it and falls back to send() otherwise. The range is sent
+        # in slices granted by the upload scheduler
+        end = offset + length
+        while offset < end:
+            size = min(end - offset, self.upload_scheduler.slice_size(upload))
+            self.upload_scheduler.acquire(upload, size)
+            connectionSocket.sendfile(file, offset, size)
+            offset += size
 
-    def file_transfer(self, filename, client_with_file):
+    def choose_codec(self, file_path, file, codecs, requester=None):
+        # samples spread over the file are compressed with every codec the requester accepts. Compressing and sending
+        # overlap, so a codec paces the transfer at whichever is slower, and it is only used if that beats sending the
+        # file raw at the requester's upload limit, or COMPRESSION_LINK_RATE without one
+        stat = os.fstat(file.fileno())
+        key = (file_path, stat.st_size, stat.st_mtime_ns)
+        samples = self.codec_samples.get(key)
+        if samples is None:
+            chunks = []
+            for i in range(COMPRESSION_SAMPLES):
+                file.seek(stat.st_size * i // COMPRESSION_SAMPLES)
+                chunks.append(file.read(CHUNK_SIZE))
+            sample = b"".join(chunks)
+            samples = {}
+            for name, (compressor_factory, _) in CODECS.items():
+                started = time.perf_counter()
+                compressor = compressor_factory()
+                compressed_size = len(compressor.compress(sample) + compressor.flush())
+                samples[name] = (compressed_size / max(len(sample), 1), (time.perf_counter() - started) / max(len(sample), 1))
+            self.codec_samples[key] = samples
+        link_rate = self.upload_scheduler.limit_of(requester) or COMPRESSION_LINK_RATE
+        codec = None
+        best_time = (1 - MIN_COMPRESSION_SAVING) / link_rate  # seconds per byte of the file
+        for name in CODECS:
+            if name in codecs:
+                ratio, compress_time = samples[name]
+                transfer_time = max(compress_time, ratio / link_rate)
+                if transfer_time < best_time:
+                    codec, best_time = name, transfer_time
+        return codec
+
+    def send_compressed(self, connectionSocket, file, offset, length, codec, upload):
+        stat = os.fstat(file.fileno())
+        key = [os.path.basename(file.name), stat.st_size, stat.st_mtime_ns, offset, length, codec]
+        cached_path = self.compressed_cache.lookup(key)
+        if cached_path is not None:
+            try:
+                with open(cached_path, 'rb') as cached_file:
+                    self.send_range(connectionSocket, cached_file, 0, os.fstat(cached_file.fileno()).st_size, upload)
+                return
+            except FileNotFoundError:
+                # evicted after the lookup
+                pass
+        # the body is compressed chunk by chunk and framed as it is sent. It is kept in the cache once it is complete if
+        # the range was requested before, unless it turns out larger than the whole cache
+        cache = [None, None]  # temporary path and file the body is written to, None while it is not kept
+        if self.compressed_cache.requested_before(key):
+            cache[0] = self.compressed_cache.temp_path(key)
+            cache[1] = open(cache[0], 'wb')
+
+        def send(compressed):
+            self.upload_scheduler.acquire(upload, FRAME_HEADER.size + len(compressed))
+            send_frame(connectionSocket, cache[1], compressed)
+            if cache[1] is not None and cache[1].tell() > self.compressed_cache.max_bytes:
+                discard()
+
+        def discard():
+            if cache[1] is not None:
+                cache[1].close()
+                os.remove(cache[0])
+                cache[0] = cache[1] = None
+
+        try:
+            compressor = CODECS[codec][0]()
+            file.seek(offset)
+            remaining = length
+            while remaining > 0:
+                data = file.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise ValueError(f"{file.name} is shorter than expected")
+                remaining -= len(data)
+                compressed = compressor.compress(data)
+                if compressed:
+                    send(compressed)
+            send(compressor.flush())
+            send(b'')
+        except BaseException:
+            discard()
+            raise
+        if cache[1] is not None:
+            cache[1].close()
+            self.compressed_cache.add(key, cache[0])
+
+    def limit(self, peer=None, rate=None):
+        # with a rate, sets the upload limit of peer ("*" for every client, None for the whole uplink), "off" removes it.
+        # Prints the limits and the rates achieved
+        if rate is not None:
+            try:
+                self.upload_scheduler.set_limit(peer, None if rate == "off" else parse_rate(rate))
+            except ValueError:
+                print(f">>> [Invalid rate {rate}]")
+                return
+        total_limit, peer_limit, own_limits = self.upload_scheduler.limits()
+        limits = []
+        if total_limit is not None:
+            limits.append(f"total {format_rate(total_limit)}")
+        if peer_limit is not None:
+            limits.append(f"every client {format_rate(peer_limit)}")
+        limits.extend(f"{peer} {format_rate(own_limit)}" for peer, own_limit in sorted(own_limits.items()))
+        print(f">>> [Upload limits: {', '.join(limits) if limits else 'none'}]")
+        rates = self.upload_scheduler.rates()
+        achieved = [f"total {format_rate(sum(rates.values()))}"]
+        achieved.extend(f"{peer} {format_rate(peer_rate)}" for peer, peer_rate in sorted(rates.items()))
+        print(f">>> [Upload rates over the last {RATE_WINDOW:.0f}s: {', '.join(achieved)}]")
+
+    def find_owners(self, filename, client_with_file=None):
+        owners = self.file_index.owners_of(filename)
+        owners.discard(self.client_name)
+        if client_with_file is not None:
+            return [client_with_file] if client_with_file in owners else []
+        return sorted(owners)
+
+    def file_transfer(self, filename, client_with_file=None):
         if self.client_name in list(self.client_database.keys()) and not self.client_database[self.client_name][ONLINE_STATUS_FIELD]:
             print(">>> [Client not online, operation allowed.]")
         else:
-            if client_with_file != self.client_name and filename in self.client_database[client_with_file][FILE_NAMES_FIELD] and self.client_database[client_with_file][ONLINE_STATUS_FIELD] is True:
-                # if I use TCP socket of client, I get "OSError: [Errno 102] Operation not supported on socket"
-                tcp_send_socket = socket(AF_INET, SOCK_STREAM)
-                tcp_send_socket.connect((self.client_database[client_with_file][IP_ADDRESS_FIELD], int(self.client_database[client_with_file][TCP_PORT_FIELD])))
-                print(f"< Connection with client {client_with_file} established. >")
-                tcp_send_socket.send(json.dumps({"REQUEST": [filename, self.client_name]}).encode())
-                print(f"< Downloading {filename}... >")
-                file = tcp_send_socket.recv(2048).decode()
-                if file != "ERROR":
-                    for word in file.split():
-                        if word == 'NEXT':
-                            print('\n')
-                        else:
-                            print(word, end=' ')
-                    print()
-                    print(f"< {filename} downloaded successfully! >")
-                else:
-                    print("<Error in downloading file.>")
-                print(f"< Connection with client {client_with_file} closed >")
-                tcp_send_socket.close()
-            else:
+            # without an owner the file is fetched in parallel from every online client that offers it
+            owners = self.find_owners(filename, client_with_file)
+            if not owners:
                 print(">>> [Invalid Request]")
+                return
+            owners, manifest = self.owners_with_same_copy(filename, owners)
+            if manifest is None:
+                print("<Error in downloading file.>")
+                return
+
+            # a single owner streams the whole file over one connection
+            segment_size = SEGMENT_SIZE if len(owners) > 1 else max(manifest["size"], 1)
+            download, partial_path = self.prepare_download(filename, manifest, segment_size)
+            print(f"< Downloading {filename} ({manifest['size']} bytes) from {', '.join(owners)}... >")
+            owner_threads = [Thread(target=self.fetch_segments, args=(filename, owner, download, partial_path))
+                             for owner in owners]
+            for owner_thread in owner_threads:
+                owner_thread.start()
+            for owner_thread in owner_threads:
+                owner_thread.join()
+            self.finish_download(filename, download, partial_path)
+            if self.hash_cache is not None:
+                self.hash_cache.save()
+
+    def batch_transfer(self, patterns, owner):
+        if self.client_name in list(self.client_database.keys()) and not self.client_database[self.client_name][ONLINE_STATUS_FIELD]:
+            print(">>> [Client not online, operation allowed.]")
+            return
+        # every pattern is a file name or a glob matched against the files the owner offers
+        offered = [filename for filename, owners in self.file_index.match() if owner in owners and owner != self.client_name]
+        filenames = []
+        for pattern in patterns:
+            if re.search(r"[*?\[]", pattern):
+                matches = fnmatch.filter(offered, pattern)
+            else:
+                matches = [pattern] if pattern in offered else []
+            if not matches:
+                print(f">>> [{pattern} is not offered by {owner}.]")
+            filenames.extend(filename for filename in matches if filename not in filenames)
+        if not filenames:
+            print(">>> [Invalid Request]")
+            return
+
+        # the manifests and then the files are requested over one connection, PIPELINE_DEPTH requests ahead of the
+        # reply being read, so a batch of small files is not paced by round trips
+        print(f"< Requesting {len(filenames)} files from client {owner}... >")
+        manifests = {}
+        downloads = []
+
+        def on_manifest(filename, reply):
+            try:
+                manifests[filename] = self.check_manifest(reply)
+            except (ConnectionError, ValueError) as e:
+                print(f"< Could not get the manifest of {filename} from client {owner}: {e} >")
+
+        failed_items = []  # files whose body failed part way, leaving the rest of it unread on the connection
+
+        def on_file(item, reply):
+            filename, download, partial_path, segment, length = item
+            if "ERROR" in reply:
+                download.fail(segment, segment.offset)
+                print(f"< Error downloading {filename} from client {owner}: {reply['ERROR']} >")
+                return
+            verified_position = [segment.offset]
+            with open(partial_path, 'r+b') as file:
+                try:
+                    self.receive_segment(connection.reader, reply, filename, owner, segment, length, download, file,
+                                         verified_position)
+                except Exception as e:
+                    download.fail(segment, verified_position[0])
+                    failed_items.append(item)
+                    print(f"< Error downloading {filename} from client {owner}: {e} >")
+                    raise
+            download.complete(segment)
+
+        connection = self.peer_connections.acquire(self.peer_address(owner))
+        try:
+            manifest_requests = [(filename, {"MANIFEST": [filename, self.client_name]}) for filename in filenames]
+            with self.profiler:
+                try:
+                    self.pipeline(connection, deque(manifest_requests), on_manifest)
+                except OSError:
+                    # a reused connection the owner closed while it was idle, the manifests are requested again
+                    if not connection.reused or manifests:
+                        raise
+                    connection.close()
+                    connection = self.peer_connections.acquire(self.peer_address(owner), reuse=False)
+                    self.pipeline(connection, deque(manifest_requests), on_manifest)
+            file_requests = deque()
+            for filename in filenames:
+                if filename in manifests:
+                    download, partial_path = self.prepare_download(filename, manifests[filename], max(manifests[filename]["size"], 1))
+                    downloads.append((filename, download, partial_path))
+                    for segment in download.take_all():
+                        file_requests.append(((filename, download, partial_path, segment, segment.remaining()),
+                                              {"REQUEST": [filename, self.client_name, segment.offset, segment.remaining(), list(self.codecs)]}))
+            while file_requests:
+                try:
+                    with self.profiler:
+                        self.pipeline(connection, file_requests, on_file)
+                except Exception:
+                    if not failed_items or not file_requests or file_requests[0][0] is not failed_items[-1]:
+                        raise
+                    # only that file fails, the requests after it are sent again over a new connection
+                    file_requests.popleft()
+                    connection.close()
+                    connection = self.peer_connections.acquire(self.peer_address(owner), reuse=False)
+        except Exception as e:
+            connection.close()
+            print(f"< Error downloading from client {owner}: {e} >")
+        else:
+            self.peer_connections.release(connection)
+        downloaded = sum(self.finish_download(filename, download, partial_path) for filename, download, partial_path in downloads)
+        if self.hash_cache is not None:
+            self.hash_cache.save()
+        print(f"< {downloaded} of {len(filenames)} files downloaded from client {owner} >")
+
+    def pipeline(self, connection, requests, on_reply):
+        # requests is a deque of (item, message) pairs, on_reply(item, reply) is called for each reply in order and has
+        # to read anything that follows the reply on the connection. A request is removed once its reply is handled, so
+        # after a failure requests holds the ones not answered yet, starting with the one that failed
+        sent = 0
+        while requests:
+            while sent < min(len(requests), PIPELINE_DEPTH):
+                send_message(connection.sock, requests[sent][1])
+                sent += 1
+            reply = read_message(connection.reader)
+            if reply is None:
+                raise ConnectionError(f"connection closed with {len(requests)} requests outstanding")
+            on_reply(requests[0][0], reply)
+            requests.popleft()
+            sent -= 1
+
+    def prepare_download(self, filename, manifest, segment_size):
+        file_size = manifest["size"]
+        partial_path = self.download_path(filename) + PARTIAL_SUFFIX
+        checkpoint_path = partial_path + CHECKPOINT_SUFFIX
+        saved_ranges = self.load_checkpoint(partial_path, checkpoint_path, manifest)
+        if saved_ranges:
+            print(f"< Resuming {filename}: {sum(end - start for start, end in saved_ranges)} of {file_size} bytes already downloaded >")
+        else:
+            with open(partial_path, 'wb') as file:
+                file.truncate(file_size)
+        local_ranges = self.copy_local_chunks(manifest, partial_path, saved_ranges)
+        if local_ranges:
+            print(f"< {sum(end - start for start, end in local_ranges)} bytes of {filename} found in local files >")
+        self.metrics.adjust("downloads.active", 1)
+        return SegmentedDownload(manifest, segment_size, checkpoint_path, saved_ranges + local_ranges), partial_path
+
+    def finish_download(self, filename, download, partial_path):
+        file_path = self.download_path(filename)
+        self.metrics.adjust("downloads.active", -1)
+        if not download.finished():
+            self.metrics.increment("downloads.failed")
+            print(f"<Error in downloading file. {download.saved_bytes()} of {download.file_size} bytes are kept, request {filename} again to resume.>")
+            return False
+        self.record_transfer("downloads", download.file_size - download.saved_at_start, time.perf_counter() - download.started)
+        os.replace(partial_path, file_path)
+        if os.path.exists(download.checkpoint_path):
+            os.remove(download.checkpoint_path)
+        if self.hash_cache is not None and os.path.dirname(file_path) == self.directory:
+            # every chunk was verified, so the manifest is already known if the file is offered later
+            self.hash_cache.store(file_path, download.manifest)
+        print(f"< {filename} downloaded successfully to {file_path}! >")
+        return True
+
+    def owners_with_same_copy(self, filename, owners):
+        # every owner is asked for its manifest at once, owners are grouped by the content digest and the largest group
+        # is used. Returns the owners and their manifest, None if no owner sent one
+
+        def request(owner):
+            try:
+                return self.request_manifest(filename, owner)
+            except Exception as e:
+                print(f"< Could not get the manifest of {filename} from client {owner}: {e} >")
+                return None
+
+        with ThreadPoolExecutor(max_workers=len(owners), thread_name_prefix="manifest") as executor:
+            manifests = list(executor.map(request, owners))
+        groups = {}  # digest -> owners
+        for owner, manifest in zip(owners, manifests):
+            if manifest is not None:
+                groups.setdefault(manifest["digest"], []).append(owner)
+        if not groups:
+            return [], None
+        digest = max(groups, key=lambda group_digest: len(groups[group_digest]))
+        skipped = [owner for owner, manifest in zip(owners, manifests) if manifest is not None and manifest["digest"] != digest]
+        if skipped:
+            print(f"< Skipping {', '.join(skipped)}: their copy of {filename} is different >")
+        return groups[digest], manifests[owners.index(groups[digest][0])]
+
+    def load_checkpoint(self, partial_path, checkpoint_path, manifest):
+        # a checkpoint is only trusted if it describes a partial file of the same content the owner has now
+        try:
+            with open(checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if checkpoint["size"] == manifest["size"] and checkpoint["digest"] == manifest["digest"] \
+                    and os.path.getsize(partial_path) == manifest["size"]:
+                return checkpoint["ranges"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return []
+
+    def copy_local_chunks(self, manifest, partial_path, saved_ranges):
+        # chunks whose hash matches a chunk of a file already in the directory are copied instead of downloaded.
+        # Only files whose manifest is cached are looked at, hashing the whole directory here would hold up the download
+        if self.hash_cache is None:
+            return []
+        chunk_size = manifest["chunk_size"]
+        needed = {}  # hash -> indexes of the chunks of the download that are not saved yet
+        for index, chunk_hash in enumerate(manifest["hashes"]):
+            start = index * chunk_size
+            if not any(saved_start <= start < saved_end for saved_start, saved_end in saved_ranges):
+                needed.setdefault(chunk_hash, []).append(index)
+        copied_ranges = []
+        with open(partial_path, 'r+b') as partial_file:
+            for local_name, local_manifest in self.hash_cache.containing(list(needed.keys())):
+                if not needed:
+                    break
+                if local_manifest["chunk_size"] != chunk_size:
+                    continue
+                try:
+                    local_file = open(os.path.join(self.directory, local_name), 'rb')
+                except OSError:
+                    continue
+                with local_file:
+                    for local_index, chunk_hash in enumerate(local_manifest["hashes"]):
+                        if chunk_hash not in needed:
+                            continue
+                        local_file.seek(local_index * chunk_size)
+                        chunk = local_file.read(chunk_size)
+                        if hashlib.sha256(chunk).hexdigest() != chunk_hash:
+                            # the local file changed after it was hashed
+                            break
+                        for index in needed.pop(chunk_hash):
+                            partial_file.seek(index * chunk_size)
+                            partial_file.write(chunk)
+                            copied_ranges.append([index * chunk_size, index * chunk_size + len(chunk)])
+            partial_file.flush()
+            os.fsync(partial_file.fileno())
+        return copied_ranges
+
+    def download_path(self, filename):
+        download_dir = self.directory if self.directory is not None else os.getcwd()
+        return os.path.join(download_dir, os.path.basename(filename))
+
+    def peer_address(self, owner):
+        # if I use TCP socket of client, I get "OSError: [Errno 102] Operation not supported on socket"
+        return self.client_database[owner][IP_ADDRESS_FIELD], int(self.client_database[owner][TCP_PORT_FIELD])
+
+    def send_peer_request(self, owner, message):
+        # returns the pooled connection the message was sent over and the owner's reply. The owner closes idle
+        # connections to make room for other peers, so a reused connection that fails before a reply is replaced
+        # by a new one
+        connection = self.peer_connections.acquire(self.peer_address(owner))
+        try:
+            send_message(connection.sock, message)
+            reply = read_message(connection.reader)
+        except OSError:
+            connection.close()
+            if connection.reused:
+                return self.send_peer_request(owner, message)
+            raise
+        except Exception:
+            connection.close()
+            raise
+        if reply is None:
+            connection.close()
+            if connection.reused:
+                return self.send_peer_request(owner, message)
+            raise ConnectionError("no reply")
+        return connection, reply
+
+    def request_manifest(self, filename, owner):
+        connection, reply = self.send_peer_request(owner, {"MANIFEST": [filename, self.client_name]})
+        self.peer_connections.release(connection)
+        return self.check_manifest(reply)
+
+    @staticmethod
+    def check_manifest(reply):
+        if "MANIFEST" not in reply:
+            raise ConnectionError(reply.get("ERROR", "no manifest in reply"))
+        manifest = reply["MANIFEST"]
+        if manifest_digest(manifest["hashes"]) != manifest["digest"]:
+            raise ValueError("manifest does not match its digest")
+        return manifest
+
+    def fetch_segments(self, filename, owner, download, partial_path):
+        print(f"< Connection with client {owner} established. >")
+        with self.profiler, open(partial_path, 'r+b') as file:
+            while True:
+                segment = download.next_segment()
+                if segment is None:
+                    break
+                verified_position = [segment.offset]
+                try:
+                    self.fetch_segment(filename, owner, segment, download, file, verified_position)
+                except Exception as e:
+                    # the rest of the range goes back to the queue for the other owners and this owner is dropped
+                    download.fail(segment, verified_position[0])
+                    print(f"< Error downloading {filename} from client {owner}: {e} >")
+                    break
+                download.complete(segment)
+        print(f"< Connection with client {owner} closed >")
+
+    def fetch_segment(self, filename, owner, segment, download, file, verified_position):
+        # the reply is checked against the length requested, the segment may shrink before the reply arrives
+        length = segment.remaining()
+        connection, reply = self.send_peer_request(owner, {"REQUEST": [filename, self.client_name, segment.offset + segment.received,
+                                                                       length, list(self.codecs)]})
+        try:
+            reusable = self.receive_segment(connection.reader, reply, filename, owner, segment, length, download, file,
+                                            verified_position)
+        except Exception:
+            connection.close()
+            raise
+        if reusable:
+            self.peer_connections.release(connection)
+        else:
+            connection.close()
+
+    def receive_segment(self, reader, reply, filename, owner, segment, length, download, file, verified_position):
+        # length is what was requested for the segment. verified_position[0] is advanced past every chunk that matched
+        # the manifest. Returns whether the whole body was read, so that the connection can carry further requests
+        manifest = download.manifest
+        chunk_size = manifest["chunk_size"]
+        start = segment.offset + segment.received
+        if "FILE" not in reply:
+            raise ConnectionError(reply.get("ERROR", "no file in reply"))
+        if reply["FILE"]["length"] != length:
+            raise ConnectionError(f"client {owner} offers a different version of {filename}")
+        codec = reply["FILE"].get("codec")
+        decompressor = CODECS[codec][1]() if codec is not None else None
+        position = start
+        saved_position = start
+        chunk_hash = hashlib.sha256()
+        try:
+            # the segment can shrink while it is being read if an idle owner takes over its tail
+            while segment.remaining() > 0:
+                if decompressor is None:
+                    chunk = reader.read(min(CHUNK_SIZE, segment.remaining()))
+                else:
+                    chunk = read_frame(reader, decompressor)
+                if not chunk:
+                    raise ConnectionError(f"connection closed with {segment.remaining()} bytes of {filename} outstanding")
+                data = chunk[:download.claim(segment, len(chunk))]
+                file.seek(position)
+                file.write(data)
+                while data:
+                    # hash what was written, checking each manifest chunk as soon as it is complete
+                    boundary = min((position // chunk_size + 1) * chunk_size, manifest["size"])
+                    part = data[:boundary - position]
+                    chunk_hash.update(part)
+                    position += len(part)
+                    data = data[len(part):]
+                    if position == boundary:
+                        if chunk_hash.hexdigest() != manifest["hashes"][(position - 1) // chunk_size]:
+                            raise ValueError(f"bytes {(position - 1) // chunk_size * chunk_size}-{boundary} failed verification")
+                        verified_position[0] = position
+                        chunk_hash = hashlib.sha256()
+                if verified_position[0] - saved_position >= CHECKPOINT_INTERVAL:
+                    download.save(file, saved_position, verified_position[0])
+                    saved_position = verified_position[0]
+        finally:
+            # whatever was verified before a failure is kept so that a later request resumes after it
+            download.save(file, saved_position, verified_position[0])
+        if position < start + length:
+            return False
+        # the frames left after the last byte only end the compressed stream
+        if decompressor is not None and read_frame(reader, decompressor):
+            raise ValueError(f"client {owner} sent more of {filename} than requested")
+        return True
 
 
 class Server(object):
 
-    def __init__(self, port):
+    def __init__(self, port, data_dir=None, workers=1, stats_file=None, profile_path=None):
         self.port = port
         self.hostname = gethostname()
         self.ip_address = gethostbyname(self.hostname)
         print(f"Server host name: {self.hostname} IP address: {self.ip_address}")
         # dictionary of dictionaries - client_name: {IP address, TCP port, UDP port, online status, file names}
         self.client_database = {}
+        self.table_version = 0  # incremented on every change to client_database, sent with every broadcast
+        # (version, client) of every change since changes_start, to send reregistering clients only what they missed
+        self.changes = []
+        self.changes_start = 0
+        # without a data directory the table only lives in memory
+        self.registry = RegistryLog(data_dir) if data_dir is not None else None
+        if self.registry is not None:
+            start = time.time()
+            self.table_version, table, self.changes_start, self.changes = self.registry.load()
+            for client, entry in table.items():
+                if entry[FILE_NAMES_FIELD] is not None:
+                    entry[FILE_NAMES_FIELD] = set(entry[FILE_NAMES_FIELD])
+            self.client_database = table
+            print(f"Loaded {len(table)} clients at table version {self.table_version} from {data_dir} in {time.time() - start:.2f}s")
+        self.outgoing = []  # datagrams sent once the changes they announce are durable
+        self.broadcasts_queued = []  # times of the broadcasts in outgoing, for their fan-out latency
+        self.metrics = Metrics()
+        self.stats_file = stats_file  # the metrics are written here every STATS_INTERVAL if set
+        self.profiler = Profiler(profile_path)
+        # with several workers each process serves the port with a full replica of the table, see run_workers
+        self.workers = workers
+        self.worker_index = 0
+        self.replication_reader = None
+        self.replication_writers = []
+        self.held_records = []  # heap of (version, change) received from other workers ahead of an earlier version
+        self.shared_version = None
+        self.partitions = {}  # client -> worker that broadcasts to it
+        # registration replies waiting for an ACK, keyed by client address, so other clients' datagrams are never
+        # mistaken for the ACK
+        self.pending_acks = RetransmitScheduler()
+        self.recent_replies = OrderedDict()  # (client address, REQUEST_ID) -> encoded reply, oldest first
+        # held while client_database changes and until the change is committed, snapshots are read from other threads
+        self.database_lock = RLock()
+        self.change_lock = self.database_lock  # taken for every change, a ChangeLock across worker processes
+        self.version_changed = Condition(self.database_lock)
+        self.snapshot_cache = {}  # (version, client or None) -> compressed snapshot, cleared when the version changes
+        if workers > 1:
+            self.run_workers()
+        else:
+            self.open_sockets()
+            self.spin_up()
+
+    def open_sockets(self):
         self.server_socket = socket(AF_INET, SOCK_DGRAM)
-        self.server_socket.bind((self.ip_address, int(port)))
-        self.retry_exit = False  # exit flag to kill the retry thread once ACK is received
+        self.snapshot_socket = socket(AF_INET, SOCK_STREAM)
+        self.snapshot_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if self.workers > 1:
+            # the kernel spreads datagrams and connections over the workers, always sending a client's to the same one
+            self.server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            self.snapshot_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        self.server_socket.bind((self.ip_address, int(self.port)))
+        self.server_socket.setblocking(False)
+        # tables too large for one datagram are served over TCP on the same port number
+        self.snapshot_socket.bind((self.ip_address, int(self.port)))
+        self.snapshot_socket.listen(DEFAULT_TCP_BACKLOG)
+        self.snapshot_socket.setblocking(False)
+        # requests that arrive over TCP are handed to the event loop, which the writer end wakes up
+        self.tcp_requests = deque()  # (message, client address)
+        self.wakeup_reader, self.wakeup_writer = socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.tcp_executor = ThreadPoolExecutor(max_workers=SNAPSHOT_THREADS, thread_name_prefix="snapshot")
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self.receive_datagrams)
+        self.selector.register(self.snapshot_socket, selectors.EVENT_READ, self.accept_snapshot_request)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self.receive_tcp_requests)
+        if self.replication_reader is not None:
+            self.selector.register(self.replication_reader, selectors.EVENT_READ, self.receive_replication)
+
+    def run_workers(self):
+        # the table is loaded once and inherited by every worker. Changes are made one at a time under version_lock:
+        # a worker catches up on the other workers' changes, applies its own with the next version from shared_version
+        # and sends it to the others over their replication pipes. Every worker applies every change and broadcasts it
+        # to its own share of the clients
+        context = multiprocessing.get_context("fork")
+        self.shared_version = context.Value('q', self.table_version, lock=False)
+        version_lock = context.Lock()
+        self.change_lock = ChangeLock(self, version_lock)
+        pipes = [context.Pipe(duplex=False) for _ in range(self.workers)]  # (reader, writer) of each worker
+        processes = [context.Process(target=self.run_worker, args=(index, pipes), daemon=True) for index in range(self.workers)]
+        for process in processes:
+            process.start()
+        print(f"Started {self.workers} server workers")
+        # the workers are stopped with the server, also when it is terminated
+        signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit())
+        try:
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                process.terminate()
+            # waited for, so the workers get to write their stats and profile without being signalled again at exit
+            for process in processes:
+                process.join()
+
+    def run_worker(self, index, pipes):
+        self.worker_index = index
+        # every worker writes its own stats and profile
+        if self.stats_file is not None:
+            self.stats_file = f"{self.stats_file}.{index}"
+        if self.profiler.path is not None:
+            self.profiler.path = f"{self.profiler.path}.{index}"
+        self.replication_reader = pipes[index][0]
+        self.replication_writers = [writer for writer_index, (_, writer) in enumerate(pipes) if writer_index != index]
+        self.open_sockets()
         self.spin_up()
 
     def spin_up(self):
+        # single threaded event loop: wakes up for incoming datagrams, snapshot connections and due retransmissions
+        if self.stats_file is not None or self.profiler.path is not None:
+            Thread(target=self.write_stats_forever, daemon=True).start()
+        try:
+            while True:
+                events = self.selector.select(self.pending_acks.next_delay())
+                with self.profiler:
+                    with self.database_lock:
+                        version = self.table_version
+                        for key, _ in events:
+                            key.data()
+                        self.pending_acks.run_due()
+                        # the changes of the whole iteration are made durable with one fsync before any reply or
+                        # broadcast announcing them is sent
+                        if self.registry is not None and self.table_version != version:
+                            start = time.perf_counter()
+                            self.registry.commit()
+                            self.metrics.observe("registry.commit_ms", (time.perf_counter() - start) * 1000)
+                    self.send_outgoing()
+        finally:
+            self.write_stats()
+
+    def write_stats(self):
+        try:
+            if self.stats_file is not None:
+                self.metrics.dump(self.stats_file)
+            self.profiler.dump()
+        except Exception as e:
+            print(f"Error {e} in writing stats")
+
+    def write_stats_forever(self):
         while True:
-            message, client_address = self.server_socket.recvfrom(2048)
+            time.sleep(STATS_INTERVAL)
+            self.write_stats()
 
-            if message.decode() != "ACK":
-                info = json.loads(message.decode())
-                operation = list(info.keys())[0]
+    def log_change(self, operation, client):
+        # called with change_lock held once a change is applied, gives it the next table version and records it
+        self.table_version += 1
+        change = {"version": self.table_version, "op": operation, "client": client, "entry": self.client_entry_to_send(client)}
+        compact = self.registry is not None and self.table_version - self.changes_start >= COMPACT_INTERVAL \
+            and not self.registry.compacting()
+        if compact:
+            change["compact"] = True
+        self.changes.append((self.table_version, client))
+        if self.registry is not None:
+            self.registry.append(change)
+        if self.replication_writers:
+            # written while holding the lock, so the log is in version order whichever worker made the change
+            if self.registry is not None:
+                self.registry.flush()
+            self.shared_version.value = self.table_version
+            data = json.dumps(change).encode()
+            for writer in self.replication_writers:
+                writer.send_bytes(data)
+        if compact:
+            self.registry.compact(self.table_version, self.convert_file_names_to_list())
+            self.changes = []
+            self.changes_start = self.table_version
+        self.version_changed.notify_all()
 
-                if operation == "REGISTER":
-                    client_name = list(info[operation].keys())[0]
-                    if client_name in list(self.client_database.keys()):
-                        if not self.client_database[client_name][ONLINE_STATUS_FIELD]:
-                            self.client_database[client_name][ONLINE_STATUS_FIELD] = True
-                            database_to_send = self.convert_file_names_to_list() # JSON cannot serialize sets (filenames) so we need to convert to list
-                            message_to_send = json.dumps({"RE_REGISTRATION": database_to_send})
-                            self.server_socket.sendto(message_to_send.encode(), client_address)
-                            self.broadcast(client_name)  # table update should not be broadcasted to client registering
-                        else:
-                            self.server_socket.sendto("Invalid".encode(), client_address)
-                    else:
-                        self.add_client_to_database(info[operation], client_name)
-                        database_to_send = self.convert_file_names_to_list() # JSON cannot serialize sets (filenames) so we need to convert to list
-                        message_to_send = json.dumps({"NEW_REGISTRATION": database_to_send})
-                        self.server_socket.sendto(message_to_send.encode(), client_address)
-                        self.broadcast(client_name)  # table update should not be broadcasted to client registering
-
-                    retry_thread = Thread(target=self.retry_register, args=(client_address,))
-                    retry_thread.start()
-                    message, client_address = self.server_socket.recvfrom(2048)
-                    if message.decode() == "ACK":
-                        self.retry_exit = True
-                        retry_thread.join()
-                        self.retry_exit = False
-
-                elif operation == "SET_FILENAMES":
-                    client_name = list(info[operation].keys())[0]
-                    self.set_files_for_client(client_name, info[operation][client_name])
-                    self.server_socket.sendto("ACK".encode(), client_address)
-                    self.broadcast(client_name) # table update should not be broadcasted to client offering files
-
-                elif operation == "DEREGISTER":
-                    client_name = info[operation]
-                    self.client_database[client_name][ONLINE_STATUS_FIELD] = False
-                    self.server_socket.sendto("ACK".encode(), client_address)
-                    self.broadcast(client_name) # table update should not be broadcasted to client deregistering
+    def receive_replication(self):
+        # changes from other workers, applied in version order
+        while self.replication_reader.poll():
+            change = json.loads(self.replication_reader.recv_bytes().decode())
+            heapq.heappush(self.held_records, (change["version"], change["client"], change))
+        while self.held_records and self.held_records[0][0] == self.table_version + 1:
+            self.apply_change(heapq.heappop(self.held_records)[2])
 
-    def convert_file_names_to_list(self):
-        database_to_send = copy.deepcopy(self.client_database)
-        for client in self.client_database.keys():
-            if self.client_database[client][FILE_NAMES_FIELD] is not None:
-                database_to_send[client][FILE_NAMES_FIELD] = list(database_to_send[client][FILE_NAMES_FIELD])
-        return database_to_send
+    def catch_up(self):
+        while self.table_version < self.shared_version.value:
+            self.replication_reader.poll(REPLICATION_POLL)
+            self.receive_replication()
+
+    def apply_change(self, change):
+        client = change["client"]
+        entry = change["entry"]
+        if entry[FILE_NAMES_FIELD] is not None:
+            entry[FILE_NAMES_FIELD] = set(entry[FILE_NAMES_FIELD])
+        self.client_database[client] = entry
+        self.table_version = change["version"]
+        self.changes.append((self.table_version, client))
+        if change.get("compact"):
+            # the worker that made the change writes the snapshot, every worker moves on to the new log
+            self.registry.rotate(self.table_version)
+            self.changes = []
+            self.changes_start = self.table_version
+        self.version_changed.notify_all()
+        self.broadcast(client)
 
-    def retry_register(self, client_address):
-        start_time = time.time()
-        retries = 0
+    def changes_since(self, version):
+        # entries changed after version, or None if the changes are not known that far back
+        if version is None or version < self.changes_start or version > self.table_version:
+            return None
+        first = bisect.bisect_left(self.changes, (version + 1,))
+        return {client: self.client_entry_to_send(client) for _, client in self.changes[first:]}
+
+    def receive_datagrams(self):
+        # drain everything that is queued on the socket before going back to select()
         while True:
-            if round(time.time() - start_time, 1) > 1 or retries > 2:
-                break
+            try:
+                message, client_address = self.server_socket.recvfrom(MAX_DATAGRAM_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # ICMP port unreachable from an earlier send surfaces here on some platforms
+                continue
+            try:
+                self.handle_message(message, client_address)
+            except Exception as e:
+                print(f"Error {e} in handling message from {client_address}")
+                traceback.print_exc()
 
-            if self.retry_exit:
-                break
+    def send_datagram(self, message_to_send, client_address):
+        self.outgoing.append((message_to_send, client_address))
+
+    def send_outgoing(self):
+        for message_to_send, client_address in self.outgoing:
+            try:
+                self.server_socket.sendto(message_to_send, client_address)
+            except (BlockingIOError, InterruptedError):
+                # send buffer full: dropped like any other lost datagram, registrations are retransmitted
+                self.metrics.increment("datagrams.dropped")
+            except OSError as e:
+                # an address the socket cannot send to, such as a broadcast address or an unreachable network, only
+                # loses that client's datagram
+                self.metrics.increment("datagrams.dropped")
+                print(f"Error {e} in sending to {client_address}")
+        self.metrics.increment("datagrams.sent", len(self.outgoing))
+        self.outgoing = []
+        # from the change until its broadcast has been sent to every recipient, including the wait for the fsync
+        sent = time.perf_counter()
+        for queued in self.broadcasts_queued:
+            self.metrics.observe("broadcast.fan_out_ms", (sent - queued) * 1000)
+        self.broadcasts_queued = []
+
+    def handle_message(self, message, client_address):
+        if message.decode() == "ACK":
+            self.metrics.increment("messages.ACK")
+            self.pending_acks.cancel(client_address)
+            return
+
+        info = json.loads(message.decode())
+        request_id = info.pop("REQUEST_ID", None)
+        if (client_address, request_id) in self.recent_replies:
+            # a retransmission of a request that was already applied, only the reply was lost
+            self.metrics.increment("messages.retransmitted")
+            self.send_datagram(self.recent_replies[(client_address, request_id)], client_address)
+            return
+        operation = list(info.keys())[0]
+        self.metrics.increment(f"messages.{operation}")
+
+        if operation == "REGISTER":
+            client_name = list(info[operation].keys())[0]
+            changed = True
+            with self.change_lock:
+                if client_name in list(self.client_database.keys()):
+                    if not self.client_database[client_name][ONLINE_STATUS_FIELD]:
+                        self.set_client_online(client_name, True)
+                        self.log_change(operation, client_name)
+                        self.send_registration_reply(self.reregistration_reply(info.get("VERSION")), client_address, request_id)
+                    else:
+                        changed = False
+                        self.send_reply({"INVALID": "Client username already in use."}, client_address, request_id)
+                else:
+                    self.add_client_to_database(info[operation], client_name)
+                    self.log_change(operation, client_name)
+                    self.send_registration_reply(self.full_table_reply("NEW_REGISTRATION"), client_address, request_id)
+            if changed:
+                self.broadcast(client_name)  # table update should not be broadcasted to client registering
+
+        elif operation == "SET_FILENAMES":
+            client_name = list(info[operation].keys())[0]
+            with self.change_lock:
+                changed = self.set_files_for_client(client_name, info[operation][client_name])
+                if changed:
+                    self.log_change(operation, client_name)
+                self.send_ack(client_address, request_id)
+            if changed:
+                self.broadcast(client_name) # table update should not be broadcasted to client offering files
+
+        elif operation == "DEREGISTER":
+            client_name = info[operation]
+            with self.change_lock:
+                self.set_client_online(client_name, False)
+                self.log_change(operation, client_name)
+                self.send_ack(client_address, request_id)
+            self.broadcast(client_name) # table update should not be broadcasted to client deregistering
+
+        elif operation == "RESYNC":
+            # a client noticed a gap in the broadcast versions and needs the whole table
+            self.send_datagram(json.dumps(self.full_table_reply("FULL_TABLE")).encode(), client_address)
 
-            if round(time.time() - start_time, 1) == 0.5 or round(time.time() - start_time,
-                                                                  1) == 1:
-                retries += 1
-                print(f"Retrying {retries} times")
-                database_to_send = self.convert_file_names_to_list() # JSON cannot serialize sets (filenames) so we need to convert to list
-                self.server_socket.sendto(json.dumps(database_to_send).encode(), client_address)
+    def send_reply(self, reply, client_address, request_id):
+        # replies echo the REQUEST_ID so the client can match them to the request, and are kept for retransmissions
+        if request_id is not None:
+            reply["REQUEST_ID"] = request_id
+        message_to_send = json.dumps(reply).encode()
+        if request_id is not None:
+            self.recent_replies[(client_address, request_id)] = message_to_send
+            if len(self.recent_replies) > REPLY_CACHE_SIZE:
+                self.recent_replies.popitem(last=False)
+        self.send_datagram(message_to_send, client_address)
+        return message_to_send
+
+    def send_registration_reply(self, reply, client_address, request_id):
+        message_to_send = self.send_reply(reply, client_address, request_id)
+
+        def resend(retries):
+            print(f"Retrying {retries} times")
+            self.metrics.increment("acks.retries")
+            self.send_datagram(message_to_send, client_address)
+
+        def give_up():
+            self.metrics.increment("acks.timeouts")
+
+        self.pending_acks.schedule(client_address, resend, give_up)
+
+    def full_table_reply(self, operation):
+        reply = {operation: self.full_table()}
+        if len(json.dumps(reply)) > UDP_PAYLOAD_LIMIT:
+            # only the version goes over UDP, the client fetches the table itself from send_snapshot
+            reply = {operation: {"version": self.table_version, "snapshot": True}}
+        return reply
+
+    def reregistration_reply(self, client_version):
+        # a client that still has its table only needs the entries that changed since its version
+        changed_clients = self.changes_since(client_version)
+        if changed_clients is not None:
+            reply = {"RE_REGISTRATION": {"version": self.table_version, "since": client_version, "clients": changed_clients}}
+            if len(json.dumps(reply)) <= UDP_PAYLOAD_LIMIT:
+                return reply
+        return self.full_table_reply("RE_REGISTRATION")
+
+    def accept_snapshot_request(self):
+        try:
+            connection_socket, addr = self.snapshot_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        # connections are served by a pool of threads so a slow peer cannot stall the event loop, and a broadcast
+        # that every client fetches over TCP does not start a thread per client
+        connection_socket.settimeout(DEFAULT_CONNECTION_TIMEOUT)
+        self.tcp_executor.submit(self.serve_tcp_connection, connection_socket)
+
+    def serve_tcp_connection(self, connection_socket):
+        try:
+            with connection_socket, connection_socket.makefile('rb') as reader:
+                message = read_message(reader)
+                if message is None:
+                    return
+                if "SNAPSHOT" in message:
+                    self.send_snapshot(connection_socket, message)
+                elif "REQUEST" in message:
+                    # a request too large for a datagram, answered over UDP like any other
+                    data = reader.read(message["REQUEST"]["length"])
+                    self.tcp_requests.append((zlib.decompress(data), (connection_socket.getpeername()[0], message["REQUEST"]["udp_port"])))
+                    self.wakeup_writer.send(b"\0")
+        except Exception as e:
+            print(f"Error {e} in serving TCP connection")
+
+    def receive_tcp_requests(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.tcp_requests:
+            message, client_address = self.tcp_requests.popleft()
+            self.metrics.increment("messages.over_tcp")
+            try:
+                self.handle_message(message, client_address)
+            except Exception as e:
+                print(f"Error {e} in handling message from {client_address}")
+                traceback.print_exc()
+
+    def send_snapshot(self, connection_socket, message):
+        self.metrics.increment("snapshots.served")
+        self.metrics.adjust("snapshots.active", 1)
+        try:
+            client = message["SNAPSHOT"]
+            with self.database_lock:
+                if message.get("VERSION") is not None:
+                    # another worker may have announced the version before this one applied it
+                    self.version_changed.wait_for(lambda: self.table_version >= message["VERSION"], SNAPSHOT_WAIT)
+                key = (self.table_version, client)
+                if key not in self.snapshot_cache:
+                    if client is None:
+                        snapshot = self.full_table()
+                    else:
+                        snapshot = {"version": self.table_version, "table": {client: self.client_entry_to_send(client)}}
+                    # snapshots are compressed once per version however many clients fetch them
+                    self.snapshot_cache = {cached_key: data for cached_key, data in self.snapshot_cache.items()
+                                           if cached_key[0] == self.table_version}
+                    self.snapshot_cache[key] = encode_snapshot(snapshot)
+                data = self.snapshot_cache[key]
+            send_message(connection_socket, {"SNAPSHOT": {"version": key[0], "length": len(data), "encoding": "zlib"}})
+            connection_socket.sendall(data)
+        except Exception as e:
+            print(f"Error {e} in sending table snapshot")
+        finally:
+            self.metrics.adjust("snapshots.active", -1)
+
+    def send_ack(self, client_address, request_id):
+        # the ACK carries the new table version since the client that made a change is left out of its broadcast
+        self.send_reply({"ACK": {"version": self.table_version}}, client_address, request_id)
+
+    def client_entry_to_send(self, client):
+        entry = dict(self.client_database[client])
+        if entry[FILE_NAMES_FIELD] is not None:
+            entry[FILE_NAMES_FIELD] = list(entry[FILE_NAMES_FIELD])
+        return entry
+
+    def convert_file_names_to_list(self):
+        # JSON cannot serialize sets (filenames), entries are copied one level deep instead of deep-copying the table
+        return {client: self.client_entry_to_send(client) for client in self.client_database.keys()}
+
+    def full_table(self):
+        return {"version": self.table_version, "table": self.convert_file_names_to_list()}
 
     def set_files_for_client(self, client_name, file_names):
         current_filenames = self.client_database[client_name][FILE_NAMES_FIELD]
@@ -344,7 +2572,12 @@ class Server(object):
             current_filenames = set(current_filenames_lst)
         else:
             current_filenames = set(file_names)
+        changed = current_filenames != self.client_database[client_name][FILE_NAMES_FIELD]
         self.client_database[client_name][FILE_NAMES_FIELD] = current_filenames
+        return changed
+
+    def set_client_online(self, client_name, online_status):
+        self.client_database[client_name][ONLINE_STATUS_FIELD] = online_status
 
     def add_client_to_database(self, info, client_name):
         new_client = {IP_ADDRESS_FIELD: info[client_name][IP_ADDRESS_FIELD],
@@ -353,13 +2586,32 @@ class Server(object):
                       FILE_NAMES_FIELD: info[client_name][FILE_NAMES_FIELD]}
         self.client_database[client_name] = new_client
 
-    def broadcast(self, to_exclude):
+    def broadcasts_to(self, client):
+        # with several workers each one broadcasts to the clients whose name hashes to it
+        if self.workers == 1:
+            return True
+        if client not in self.partitions:
+            self.partitions[client] = zlib.crc32(client.encode()) % self.workers
+        return self.partitions[client] == self.worker_index
+
+    def broadcast(self, changed_client):
+        # only the changed entry is sent, encoded once for all recipients
+        delta = {"version": self.table_version, "clients": {changed_client: self.client_entry_to_send(changed_client)}}
+        message_to_send = json.dumps({"BROADCAST": delta}).encode()
+        if len(message_to_send) > UDP_PAYLOAD_LIMIT:
+            # recipients fetch the entry over TCP
+            message_to_send = json.dumps({"BROADCAST": {"version": self.table_version, "snapshot": changed_client}}).encode()
+        queued = time.perf_counter()
+        recipients = 0
         for client in self.client_database.keys():
-            if self.client_database[client][ONLINE_STATUS_FIELD] and client != to_exclude:
+            if self.client_database[client][ONLINE_STATUS_FIELD] and client != changed_client and self.broadcasts_to(client):
                 client_address = (
                     self.client_database[client][IP_ADDRESS_FIELD], int(self.client_database[client][UDP_PORT_FIELD]))
-                database_to_send = self.convert_file_names_to_list() # JSON cannot serialize sets (filenames) so we need to convert to list
-                self.server_socket.sendto(json.dumps({"BROADCAST": database_to_send}).encode(), client_address)
+                self.send_datagram(message_to_send, client_address)
+                recipients += 1
+        self.metrics.observe("broadcast.recipients", recipients)
+        if recipients:
+            self.broadcasts_queued.append(queued)
 
 
 if __name__ == "__main__":
@@ -369,9 +2621,13 @@ if __name__ == "__main__":
         mode = sys.argv[1]
         if mode == '-s':
             server_port = sys.argv[2]
+            options = parse_options(sys.argv[3:], {"data_dir": str, "workers": int, "stats_file": str, "profile": str})
             if int(server_port) < 1024 or int(server_port) > 65535:
                 sys.exit("[Invalid server port]")
-            server = Server(server_port)
+            # a terminated server still writes its stats and profile
+            signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit())
+            server = Server(server_port, data_dir=options.get("data_dir", DEFAULT_DATA_DIR), workers=options.get("workers", 1),
+                            stats_file=options.get("stats_file"), profile_path=options.get("profile"))
 
         elif mode == '-c':
             client_name = sys.argv[2]
@@ -379,6 +2635,9 @@ if __name__ == "__main__":
             server_port = sys.argv[4]
             client_udp_port = sys.argv[5]
             client_tcp_port = sys.argv[6]
+            options = parse_options(sys.argv[7:], {"backlog": int, "max_transfers": int, "timeout": float, "cache_size": int,
+                                                   "stats_file": str, "profile": str, "upload_limit": parse_rate,
+                                                   "peer_upload_limit": parse_rate, "compress": parse_codecs})
 
             if re.search("^((25[0-5]|(2[0-4]|1\d|[1-9]|)\d)(\.(?!$)|$)){4}$", server_ip) is None:
                 sys.exit("[Invalid server IP address]")
@@ -392,14 +2651,27 @@ if __name__ == "__main__":
             if int(client_tcp_port) < 1024 or int(client_tcp_port) > 65535:
                 sys.exit("[Invalid client TCP port]")
 
-            client = Client(client_name, client_udp_port, client_tcp_port)
+            client = Client(client_name, client_udp_port, client_tcp_port,
+                            tcp_backlog=options.get("backlog", DEFAULT_TCP_BACKLOG),
+                            max_transfers=options.get("max_transfers", DEFAULT_MAX_TRANSFERS),
+                            connection_timeout=options.get("timeout", DEFAULT_CONNECTION_TIMEOUT),
+                            compressed_cache_size=options.get("cache_size", DEFAULT_COMPRESSED_CACHE_SIZE),
+                            stats_file=options.get("stats_file"), profile_path=options.get("profile"),
+                            upload_limit=options.get("upload_limit"), peer_upload_limit=options.get("peer_upload_limit"),
+                            codecs=options.get("compress", ()))
+            # replies to register are read by the broadcast thread, so it has to be running first
+            broadcast_thread = Thread(target=client.listen_to_broadcast, args=(), daemon=True)
+            broadcast_thread.start()
+            retransmit_thread = Thread(target=client.retransmits.run_forever, args=(), daemon=True)
+            retransmit_thread.start()
             register_thread = Thread(target=client.register, args=(server_ip, server_port))
             register_thread.start()
             register_thread.join()
-            broadcast_thread = Thread(target=client.listen_to_broadcast, args=(), daemon=True)
-            broadcast_thread.start()
             listen_for_file_request = Thread(target=client.listen_for_file_request, args=(), daemon=True)
             listen_for_file_request.start()
+            if client.stats_file is not None or client.profiler.path is not None:
+                stats_thread = Thread(target=client.write_stats_forever, args=(), daemon=True)
+                stats_thread.start()
             while True:
                 user_input = raw_input(">>> ")
                 input_split = user_input.split(" ")
@@ -413,17 +2685,55 @@ if __name__ == "__main__":
                         offer_files_thread.start()
                         offer_files_thread.join()
                 elif input_split[0] == "list":
-                    list_files_thread = Thread(target=client.file_list, args=())
+                    # "list [page]"
+                    if len(input_split) > 1 and not input_split[1].isdigit():
+                        print(">>> Invalid operation.")
+                        continue
+                    list_files_thread = Thread(target=client.file_list, args=tuple(int(page) for page in input_split[1:2]))
                     list_files_thread.start()
                     list_files_thread.join()
+                elif input_split[0] == "search":
+                    # "search <prefix or glob> [page]"
+                    if len(input_split) < 2 or (len(input_split) > 2 and not input_split[2].isdigit()):
+                        print(">>> Invalid operation.")
+                        continue
+                    search_files_thread = Thread(target=client.search, args=(input_split[1],) + tuple(int(page) for page in input_split[2:3]))
+                    search_files_thread.start()
+                    search_files_thread.join()
                 elif input_split[0] == "request":
-                    request_files_thread = Thread(target=client.file_transfer(input_split[1], input_split[2]))
-                    request_files_thread.start()
-                    request_files_thread.join()
+                    # "request <filename>" downloads from every online owner, "request <filename> <client>" from one and
+                    # "request <filename or glob> ... <client>" several files from one owner over one connection
+                    if len(input_split) > 3 or (len(input_split) == 3 and re.search(r"[*?\[]", input_split[1])):
+                        request_files_thread = Thread(target=client.batch_transfer, args=(input_split[1:-1], input_split[-1]))
+                        request_files_thread.start()
+                        request_files_thread.join()
+                    elif len(input_split) > 1:
+                        request_files_thread = Thread(target=client.file_transfer, args=tuple(input_split[1:3]))
+                        request_files_thread.start()
+                        request_files_thread.join()
                 elif input_split[0] == "dereg":
                     dereg_thread = Thread(target=client.deregister, args=())
                     dereg_thread.start()
                     dereg_thread.join()
+                elif input_split[0] == "limit":
+                    # "limit" shows the upload limits and rates, "limit total <rate>" limits the whole uplink and
+                    # "limit peer <client or *> <rate>" one or every requesting client, "off" as the rate removes a limit
+                    if len(input_split) == 1:
+                        limit_args = ()
+                    elif len(input_split) == 3 and input_split[1] == "total":
+                        limit_args = (None, input_split[2])
+                    elif len(input_split) == 4 and input_split[1] == "peer":
+                        limit_args = (input_split[2], input_split[3])
+                    else:
+                        print(">>> Invalid operation.")
+                        continue
+                    limit_thread = Thread(target=client.limit, args=limit_args)
+                    limit_thread.start()
+                    limit_thread.join()
+                elif input_split[0] == "stats":
+                    stats_thread = Thread(target=client.stats, args=())
+                    stats_thread.start()
+                    stats_thread.join()
                 elif input_split[0] == "rereg":
                     rereg_thread = Thread(target=client.register, args=(server_ip, server_port))
                     rereg_thread.start()
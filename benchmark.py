@@ -0,0 +1,270 @@
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import statistics
+import subprocess
+import contextlib
+import platform
+from threading import Thread, Lock
+from socket import gethostname, gethostbyname
+
+import FileApp
+from FileApp import Client, parse_options, REORDER_KEY
+
+DEFAULT_PORT = 15000
+DEFAULT_CLIENT_COUNTS = "10,50,100"  # clients registered before each round of control plane measurements
+DEFAULT_OFFERS = 20  # offers timed per round of the broadcast fan-out measurement
+DEFAULT_FILE_SIZES = "64K,1M,16M,64M"
+DEFAULT_CONCURRENCY = "1,4,8"  # clients downloading the same file at once
+SERVER_STARTUP_TIME = 1.0  # seconds given to the server subprocess to bind its port
+CONVERGENCE_TIMEOUT = 10.0  # seconds to wait for every client to apply a broadcast before counting it as lost
+SIZE_UNITS = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+
+
+def parse_size(value):
+    if value[-1].upper() in SIZE_UNITS:
+        return int(value[:-1]) * SIZE_UNITS[value[-1].upper()]
+    return int(value)
+
+
+def parse_list(value, convert):
+    return [convert(item) for item in value.split(",") if item]
+
+
+def summarize(samples):
+    # latencies in milliseconds
+    if not samples:
+        return {"count": 0}
+    samples = sorted(sample * 1000 for sample in samples)
+    return {"count": len(samples), "mean_ms": round(statistics.mean(samples), 3),
+            "p50_ms": round(samples[len(samples) // 2], 3), "p95_ms": round(samples[int(len(samples) * 0.95)], 3),
+            "p99_ms": round(samples[int(len(samples) * 0.99)], 3), "max_ms": round(samples[-1], 3)}
+
+
+class Benchmark(object):
+    # a local server subprocess and simulated clients in this process, all on the host's address. Every client port
+    # is allocated upwards from the server port
+
+    def __init__(self, port, workers, work_dir):
+        self.port = port
+        self.workers = workers
+        self.work_dir = work_dir
+        self.server_ip = gethostbyname(gethostname())
+        self.next_port = port + 1
+        self.server = None
+        self.server_log_path = os.path.join(work_dir, "server.log")
+        self.server_stats_path = os.path.join(work_dir, "server_stats.json")
+        self.lock = Lock()
+        self.counters = {"client_resends": 0, "client_timeouts": 0, "resync_requests": 0, "registration_failures": 0,
+                         "broadcasts_not_applied": 0, "failed_transfers": 0}
+        self.clients = []
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def start_server(self):
+        with open(self.server_log_path, 'w') as server_log:
+            self.server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "FileApp.py"),
+                                            "-s", str(self.port), "--workers", str(self.workers),
+                                            "--data-dir", os.path.join(self.work_dir, "server_data"),
+                                            "--stats-file", self.server_stats_path],
+                                           stdout=server_log, stderr=subprocess.STDOUT)
+        time.sleep(SERVER_STARTUP_TIME)
+
+    def stop_server(self):
+        # returns the metrics the server wrote as it stopped, one set per worker
+        self.server.terminate()
+        self.server.wait()
+        if self.workers == 1:
+            stats_paths = [self.server_stats_path]
+        else:
+            stats_paths = [f"{self.server_stats_path}.{index}" for index in range(self.workers)]
+        server_metrics = []
+        for stats_path in stats_paths:
+            with open(stats_path) as stats_file:
+                server_metrics.append(json.load(stats_file))
+        return server_metrics
+
+    def new_client(self, listen=False):
+        name = f"bench{len(self.clients)}"
+        client = Client(name, self.next_port, self.next_port + 1)
+        self.next_port += 2
+        self.count_retries(client)
+        Thread(target=client.listen_to_broadcast, daemon=True).start()
+        Thread(target=client.retransmits.run_forever, daemon=True).start()
+        if listen:
+            Thread(target=client.listen_for_file_request, daemon=True).start()
+        self.clients.append(client)
+        return client
+
+    def count_retries(self, client):
+        # every retransmission and every request that ran out of retries is counted
+        schedule = client.retransmits.schedule
+        request_resync = client.request_resync
+
+        def counting_schedule(key, resend, give_up=None):
+            if key == REORDER_KEY:
+                return schedule(key, resend, give_up)
+
+            def counted_resend(retries):
+                self.count("client_resends")
+                resend(retries)
+
+            def counted_give_up():
+                self.count("client_timeouts")
+                if give_up is not None:
+                    give_up()
+
+            return schedule(key, counted_resend, counted_give_up)
+
+        def counting_request_resync():
+            self.count("resync_requests")
+            request_resync()
+
+        client.retransmits.schedule = counting_schedule
+        client.request_resync = counting_request_resync
+
+    def run_concurrently(self, target, items):
+        # returns how long target took for each item, None where it failed
+        durations = [None] * len(items)
+
+        def timed(index, item):
+            start = time.perf_counter()
+            try:
+                if target(item) is not False:
+                    durations[index] = time.perf_counter() - start
+            except (Exception, SystemExit):
+                pass
+
+        threads = [Thread(target=timed, args=(index, item)) for index, item in enumerate(items)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return durations
+
+    def register(self, client):
+        client.register(self.server_ip, self.port)
+        return self.server_ip == client.server_ip and client.client_name in client.client_database
+
+    def wait_for_version(self, clients, version):
+        deadline = time.perf_counter() + CONVERGENCE_TIMEOUT
+        while time.perf_counter() < deadline:
+            if all(client.table_version >= version for client in clients):
+                return True
+            time.sleep(0.0005)
+        return False
+
+    def run_control_plane(self, client_counts, offers):
+        rounds = []
+        offer_dir = os.path.join(self.work_dir, "offers")
+        os.makedirs(offer_dir, exist_ok=True)
+        for client_count in client_counts:
+            new_clients = [self.new_client() for _ in range(client_count - len(self.clients))]
+            registration = self.run_concurrently(self.register, new_clients)
+            self.count("registration_failures", registration.count(None))
+            for client in new_clients:
+                client.set_dir(offer_dir)
+            clients = [client for client in self.clients if client.client_name in client.client_database]
+            # every client changes its entry at once, which also broadcasts each change to all the others
+            offer_round_trips = self.run_concurrently(lambda client: client.offer([f"{client.client_name}-{len(rounds)}"]), clients)
+            time.sleep(1)
+
+            # one client changes its entry at a time and the others are timed until they have all applied it
+            fan_out = []
+            for i in range(offers):
+                start = time.perf_counter()
+                clients[0].offer([f"fanout-{len(rounds)}-{i}"])
+                if self.wait_for_version(clients[1:], clients[0].table_version):
+                    fan_out.append(time.perf_counter() - start)
+                else:
+                    self.count("broadcasts_not_applied")
+            rounds.append({"clients": len(clients), "registration": summarize([d for d in registration if d is not None]),
+                           "offer_round_trip": summarize([d for d in offer_round_trips if d is not None]),
+                           "broadcast_fan_out": summarize(fan_out)})
+        return rounds
+
+    def run_transfers(self, file_sizes, concurrency_levels):
+        uploader_dir = os.path.join(self.work_dir, "uploads")
+        os.makedirs(uploader_dir, exist_ok=True)
+        uploader = self.new_client(listen=True)
+        self.register(uploader)
+        uploader.set_dir(uploader_dir)
+        file_names = []
+        for file_size in file_sizes:
+            file_name = f"random-{file_size}.bin"
+            with open(os.path.join(uploader_dir, file_name), 'wb') as file:
+                for offset in range(0, file_size, FileApp.CHUNK_SIZE):
+                    file.write(os.urandom(min(FileApp.CHUNK_SIZE, file_size - offset)))
+            file_names.append(file_name)
+        uploader.offer(file_names)
+        downloaders = [self.new_client() for _ in range(max(concurrency_levels))]
+        for downloader in downloaders:
+            self.register(downloader)
+        time.sleep(1)
+
+        runs = []
+        for file_size, file_name in zip(file_sizes, file_names):
+            # the first request for a file also samples its compressibility, which later requests reuse
+            self.download(downloaders[:1], file_name, uploader)
+            for concurrency in concurrency_levels:
+                start = time.perf_counter()
+                completed = self.download(downloaders[:concurrency], file_name, uploader)
+                seconds = time.perf_counter() - start
+                self.count("failed_transfers", concurrency - completed)
+                runs.append({"file_size": file_size, "concurrency": concurrency, "completed": completed,
+                             "seconds": round(seconds, 4),
+                             "throughput_mb_per_s": round(completed * file_size / seconds / (1024 * 1024), 2)})
+        return runs
+
+    def download(self, downloaders, file_name, uploader):
+        # each download goes into an empty directory so that nothing is resumed or copied from local files
+        download_dirs = [tempfile.mkdtemp(dir=self.work_dir) for _ in downloaders]
+        for downloader, download_dir in zip(downloaders, download_dirs):
+            downloader.set_dir(download_dir)
+        self.run_concurrently(lambda downloader: downloader.file_transfer(file_name, uploader.client_name), downloaders)
+        expected_size = os.path.getsize(os.path.join(uploader.directory, file_name))
+        completed = sum(1 for download_dir in download_dirs if os.path.exists(os.path.join(download_dir, file_name))
+                        and os.path.getsize(os.path.join(download_dir, file_name)) == expected_size)
+        for download_dir in download_dirs:
+            shutil.rmtree(download_dir, ignore_errors=True)
+        return completed
+
+
+if __name__ == "__main__":
+    # python benchmark.py [--port <n>] [--workers <n>] [--clients <n,n,...>] [--offers <n>] [--sizes <size,size,...>]
+    #                     [--concurrency <n,n,...>] [--output <file>]
+    options = parse_options(sys.argv[1:], {"port": int, "workers": int, "clients": str, "offers": int, "sizes": str,
+                                           "concurrency": str, "output": str})
+    client_counts = parse_list(options.get("clients", DEFAULT_CLIENT_COUNTS), int)
+    file_sizes = parse_list(options.get("sizes", DEFAULT_FILE_SIZES), parse_size)
+    concurrency_levels = parse_list(options.get("concurrency", DEFAULT_CONCURRENCY), int)
+    work_dir = tempfile.mkdtemp(prefix="fileapp-benchmark-")
+    benchmark = Benchmark(options.get("port", DEFAULT_PORT), options.get("workers", 1), work_dir)
+    results = {"python": platform.python_version(), "cpus": os.cpu_count(), "workers": benchmark.workers}
+    try:
+        # the clients' console output is not part of the results
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            benchmark.start_server()
+            try:
+                results["control_plane"] = benchmark.run_control_plane(client_counts, options.get("offers", DEFAULT_OFFERS))
+                results["transfers"] = benchmark.run_transfers(file_sizes, concurrency_levels)
+            finally:
+                server_metrics = benchmark.stop_server()
+        server_resends = sum(metrics["counters"].get("acks.retries", 0) for metrics in server_metrics)
+        results["retries"] = dict(benchmark.counters, server_registration_resends=server_resends)
+        results["server_metrics"] = server_metrics
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    output = json.dumps(results, indent=2)
+    if "output" in options:
+        with open(options["output"], 'w') as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+    # the clients' listener threads are not stopped
+    os._exit(0)